@@ -1,9 +1,10 @@
 import asyncio
+from contextlib import aclosing
 from dataclasses import dataclass, field
-import time, importlib, inspect, os, json
+import time, os, json
 from typing import Any, Optional, Dict
 import uuid
-from python.helpers import extract_tools, rate_limiter, files, errors
+from python.helpers import extract_tools, rate_limiter, files, errors, templates, tokens
 from python.helpers.print_style import PrintStyle
 from langchain.schema import AIMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
@@ -12,7 +13,7 @@ from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.language_models.llms import BaseLLM
 from langchain_core.embeddings import Embeddings
 import python.helpers.log as Log
-from python.helpers.dirty_json import DirtyJson
+from python.helpers.dirty_json import DirtyJsonStream
 from python.helpers.defer import DeferredTask
 
 
@@ -29,7 +30,9 @@ class AgentContext:
         self.config = config
         self.log = Log.Log()
         self.agent0 = agent0 or Agent(0, self.config, self)
-        self.paused = False
+        self._paused = False
+        self._resumed: asyncio.Event | None = None  # set when unpaused, created on the agent's event loop
+        self._loop: asyncio.AbstractEventLoop | None = None
         self.streaming_agent: Agent | None = None
         self.process: DeferredTask | None = None
         AgentContext._counter += 1
@@ -54,6 +57,27 @@ class AgentContext:
             context.process.kill()
         return context
 
+    @property
+    def paused(self) -> bool:
+        return self._paused
+
+    @paused.setter
+    def paused(self, value: bool):
+        # can be called from any thread (web UI, CLI key capture)
+        self._paused = value
+        if not value and self._loop and self._resumed and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._resumed.set)
+
+    async def wait_if_paused(self):
+        while self._paused:
+            loop = asyncio.get_running_loop()
+            if self._loop is not loop or not self._resumed:
+                self._resumed = asyncio.Event()
+                self._loop = loop
+            self._resumed.clear()
+            if self._paused:  # unpausing from another thread sets the event after this point
+                await self._resumed.wait()
+
     def reset(self):
         if self.process:
             self.process.kill()
@@ -91,12 +115,21 @@ class AgentConfig:
     prompts_subdir: str = ""
     memory_subdir: str = ""
     knowledge_subdir: str = ""
+    memory_flush_seconds: float = 30
+    memory_flush_ops: int = 1000
+    memory_index_type: str = "hnsw"
+    memory_index_promote_at: int = 50000
+    memory_cache_size: int = 8
+    memory_cache_idle_seconds: float = 1800
+    memory_cache_max_mb: float = 0
     auto_memory_count: int = 3
     auto_memory_skip: int = 2
+    auto_memory_deadline_seconds: float = 1.0
     rate_limit_seconds: int = 60
     rate_limit_requests: int = 15
     rate_limit_input_tokens: int = 0
     rate_limit_output_tokens: int = 0
+    rate_limit_weight: float = 1.0
     msgs_keep_max: int = 25
     msgs_keep_start: int = 5
     msgs_keep_end: int = 10
@@ -148,25 +181,24 @@ class Agent:
         self.agent_name = f"Agent {self.number}"
 
         self.history = []
+        self.history_tokens = tokens.HistoryTokens()  # cached token counts of history messages
         self.last_message = ""
         self.intervention_message = ""
-        self.rate_limiter = rate_limiter.RateLimiter(
-            self.context.log,
-            max_calls=self.config.rate_limit_requests,
-            max_input_tokens=self.config.rate_limit_input_tokens,
-            max_output_tokens=self.config.rate_limit_output_tokens,
-            window_seconds=self.config.rate_limit_seconds,
-        )
+        # rate limiters are shared by all agents and contexts using the same model endpoint
+        self.rate_limiter = self.get_rate_limiter(self.config.chat_model)
+        self.utility_rate_limiter = self.get_rate_limiter(self.config.utility_model)
         self.data = {}  # free data object all the tools can use
+        self.memory_task: asyncio.Task | None = None  # background memory recall
+        self.memory_skip_counter = 0
 
     async def message_loop(self, msg: str):
         try:
             printer = PrintStyle(italic=True, font_color="#b3ffd9", padding=False)
             user_message = self.read_prompt("fw.user_message.md", message=msg)
+            self.memory_skip_counter = 0  # recall memories for every new user message
             await self.append_message(
                 user_message, human=True
-            )  # Append the user's input to the history
-            memories = await self.fetch_memories(True)
+            )  # Append the user's input to the history, starts memory recall in the background
 
             while (
                 True
@@ -195,9 +227,10 @@ class Agent:
                     inputs = {"messages": self.history}
                     chain = prompt | self.config.chat_model
 
-                    formatted_inputs = prompt.format(messages=self.history)
-                    tokens = int(len(formatted_inputs) / 4)
-                    self.rate_limiter.limit_call_and_input(tokens)
+                    input_tokens = (
+                        tokens.count_message_tokens(system) + self.history_tokens.total
+                    )
+                    rate_record = await self.rate_limit(self.rate_limiter, input_tokens)
 
                     # output that the agent is starting
                     PrintStyle(
@@ -209,29 +242,37 @@ class Agent:
                     log = self.context.log.log(
                         type="agent", heading=f"{self.agent_name}: Generating:"
                     )
-
-                    async for chunk in chain.astream(inputs):
-                        await self.handle_intervention(
-                            agent_response
-                        )  # wait for intervention and handle it, if paused
-
-                        if isinstance(chunk, str):
-                            content = chunk
-                        elif hasattr(chunk, "content"):
-                            content = str(chunk.content)
-                        else:
-                            content = str(chunk)
-
-                        if content:
-                            printer.stream(content)  # output the agent response stream
-                            agent_response += (
-                                content  # concatenate stream into the response
-                            )
-                            self.log_from_stream(agent_response, log)
+                    parser = DirtyJsonStream()  # parses the response as it streams
+
+                    # closing the stream early cancels the request to the model
+                    async with aclosing(chain.astream(inputs)) as stream:
+                        async for chunk in stream:
+                            await self.handle_intervention(
+                                agent_response
+                            )  # wait for intervention and handle it, if paused
+
+                            if isinstance(chunk, str):
+                                content = chunk
+                            elif hasattr(chunk, "content"):
+                                content = str(chunk.content)
+                            else:
+                                content = str(chunk)
+
+                            if content:
+                                printer.stream(content)  # output the agent response stream
+                                agent_response += (
+                                    content  # concatenate stream into the response
+                                )
+                                self.log_from_stream(agent_response, content, parser, log)
+
+                                if self.is_tool_request_complete(parser):
+                                    # dispatch the tool right away, ignore anything the model adds after the object
+                                    agent_response = agent_response[: parser.end]
+                                    break
 
                     self.rate_limiter.set_output_tokens(
-                        int(len(agent_response) / 4)
-                    )  # rough estimation
+                        tokens.count_tokens(agent_response), rate_record
+                    )
 
                     await self.handle_intervention(agent_response)
 
@@ -263,6 +304,8 @@ class Agent:
                 except InterventionException as e:
                     pass  # intervention message has been handled in handle_intervention(), proceed with conversation loop
                 except asyncio.CancelledError as e:
+                    if self.memory_task:
+                        self.memory_task.cancel()
                     PrintStyle(
                         font_color="white", background_color="red", padding=True
                     ).print(f"Context {self.context.id} terminated during message loop")
@@ -285,22 +328,25 @@ class Agent:
             self.context.streaming_agent = None  # unset current streamer
 
     def read_prompt(self, file: str, **kwargs):
-        content = ""
-        if self.config.prompts_subdir:
-            try:
-                content = files.read_file(
-                    files.get_abs_path(
-                        f"./prompts/{self.config.prompts_subdir}/{file}"
-                    ),
-                    **kwargs,
-                )
-            except Exception as e:
-                pass
-        if not content:
-            content = files.read_file(
-                files.get_abs_path(f"./prompts/default/{file}"), **kwargs
-            )
-        return content
+        return templates.get_registry(self.config.prompts_subdir).render(file, **kwargs)
+
+    def get_rate_limiter(self, model) -> rate_limiter.RateLimiter:
+        return rate_limiter.get_limiter(
+            model,
+            max_calls=self.config.rate_limit_requests,
+            max_input_tokens=self.config.rate_limit_input_tokens,
+            max_output_tokens=self.config.rate_limit_output_tokens,
+            window_seconds=self.config.rate_limit_seconds,
+        )
+
+    async def rate_limit(self, limiter: rate_limiter.RateLimiter, input_tokens: int):
+        # calls of one context queue in order, contexts share the endpoint by their weight
+        return await limiter.acquire(
+            input_tokens,
+            logger=self.context.log,
+            owner=self.context.id,
+            weight=self.config.rate_limit_weight,
+        )
 
     def get_data(self, field: str):
         return self.data.get(field, None)
@@ -312,9 +358,11 @@ class Agent:
         message_type = "human" if human else "ai"
         if self.history and self.history[-1].type == message_type:
             self.history[-1].content += "\n\n" + msg
+            self.history_tokens.extend_last("\n\n" + msg)
         else:
             new_message = HumanMessage(content=msg) if human else AIMessage(content=msg)
             self.history.append(new_message)
+            self.history_tokens.append(msg)
             await self.cleanup_history(
                 self.config.msgs_keep_max,
                 self.config.msgs_keep_start,
@@ -322,11 +370,15 @@ class Agent:
             )
         if message_type == "ai":
             self.last_message = msg
+        else:
+            self.start_memory_recall()  # recall for the next prompt while the loop goes on
 
     def concat_messages(self, messages):
         return "\n".join([f"{msg.type}: {msg.content}" for msg in messages])
 
-    async def send_adhoc_message(self, system: str, msg: str, output_label: str):
+    async def send_adhoc_message(
+        self, system: str, msg: str, output_label: str, printout: bool = True
+    ):
         prompt = ChatPromptTemplate.from_messages(
             [SystemMessage(content=system), HumanMessage(content=msg)]
         )
@@ -337,21 +389,21 @@ class Agent:
         logger = None
 
         if output_label:
-            PrintStyle(
-                bold=True, font_color="orange", padding=True, background_color="white"
-            ).print(f"{self.agent_name}: {output_label}:")
-            printer = PrintStyle(italic=True, font_color="orange", padding=False)
+            if printout:  # background calls only log, not to mix with the main stream in console
+                PrintStyle(
+                    bold=True, font_color="orange", padding=True, background_color="white"
+                ).print(f"{self.agent_name}: {output_label}:")
+                printer = PrintStyle(italic=True, font_color="orange", padding=False)
             logger = self.context.log.log(
                 type="adhoc", heading=f"{self.agent_name}: {output_label}:"
             )
 
-        formatted_inputs = prompt.format()
-        tokens = int(len(formatted_inputs) / 4)
-        self.rate_limiter.limit_call_and_input(tokens)
+        input_tokens = tokens.count_message_tokens(system) + tokens.count_message_tokens(msg)
+        rate_record = await self.rate_limit(self.utility_rate_limiter, input_tokens)
 
         async for chunk in chain.astream({}):
-            if self.handle_intervention():
-                break  # wait for intervention and handle it, if paused
+            if self.context.paused:
+                await self.context.wait_if_paused()  # wait if paused, intervention is handled by the message loop
 
             if isinstance(chunk, str):
                 content = chunk
@@ -366,7 +418,7 @@ class Agent:
             if logger:
                 logger.update(content=response)
 
-        self.rate_limiter.set_output_tokens(int(len(response) / 4))
+        self.utility_rate_limiter.set_output_tokens(tokens.count_tokens(response), rate_record)
 
         return response
 
@@ -407,12 +459,13 @@ class Agent:
         new_middle_part = await self.replace_middle_messages(middle_part)
 
         self.history = first_x + new_middle_part + last_y
+        self.history_tokens.rebuild(self.history)
 
         return self.history
 
     async def handle_intervention(self, progress: str = ""):
-        while self.context.paused:
-            await asyncio.sleep(0.1)  # wait if paused
+        if self.context.paused:
+            await self.context.wait_if_paused()  # wait if paused
         if (
             self.intervention_message
         ):  # if there is an intervention message, but not yet processed
@@ -435,19 +488,41 @@ class Agent:
         tool_request = extract_tools.json_parse_dirty(msg)
 
         if tool_request is not None:
-            tool_name = tool_request.get("tool_name", "")
-            tool_args = tool_request.get("tool_args", {})
-            tool = self.get_tool(tool_name, tool_args, msg)
-
-            await self.handle_intervention()  # wait if paused and handle intervention message if needed
-            await tool.before_execution(**tool_args)
-            await self.handle_intervention()  # wait if paused and handle intervention message if needed
-            response = await tool.execute(**tool_args)
-            await self.handle_intervention()  # wait if paused and handle intervention message if needed
-            await tool.after_execution(response)
-            await self.handle_intervention()  # wait if paused and handle intervention message if needed
-            if response.break_loop:
-                return response.message
+            tools = [
+                self.get_tool(tool_name, tool_args, msg)
+                for tool_name, tool_args in extract_tools.get_tool_calls(tool_request)
+            ]
+
+            # calls run in order, consecutive parallel safe calls run together
+            start = 0
+            while start < len(tools):
+                end = start + 1
+                if self.is_parallel_safe(tools[start]):
+                    while end < len(tools) and self.is_parallel_safe(tools[end]):
+                        end += 1
+                batch = tools[start:end]
+                start = end
+
+                await self.handle_intervention()  # wait if paused and handle intervention message if needed
+                for tool in batch:
+                    await tool.before_execution(**tool.args)
+                await self.handle_intervention()  # wait if paused and handle intervention message if needed
+                if len(batch) == 1:
+                    responses = [await batch[0].execute(**batch[0].args)]
+                else:
+                    responses = await asyncio.gather(
+                        *[tool.execute(**tool.args) for tool in batch],
+                        return_exceptions=True,
+                    )
+                await self.handle_intervention()  # wait if paused and handle intervention message if needed
+                # responses go to history in the order of the calls
+                for tool, response in zip(batch, responses):
+                    if isinstance(response, BaseException):
+                        raise response
+                    await tool.after_execution(response)
+                    if response.break_loop:
+                        return response.message
+                await self.handle_intervention()  # wait if paused and handle intervention message if needed
         else:
             msg = self.read_prompt("fw.msg_misformat.md")
             await self.append_message(msg, human=True)
@@ -456,56 +531,77 @@ class Agent:
                 type="error", content=f"{self.agent_name}: Message misformat:"
             )
 
+    def is_parallel_safe(self, tool):
+        return isinstance(tool.args, dict) and type(tool).is_parallel_safe(tool.args)
+
     def get_tool(self, name: str, args: dict, message: str, **kwargs):
         from python.tools.unknown import Unknown
-        from python.helpers.tool import Tool
-
-        tool_class = Unknown
-        if files.exists("python/tools", f"{name}.py"):
-            module = importlib.import_module(
-                "python.tools." + name
-            )  # Import the module
-            class_list = inspect.getmembers(
-                module, inspect.isclass
-            )  # Get all functions in the module
-
-            for cls in class_list:
-                if cls[1] is not Tool and issubclass(cls[1], Tool):
-                    tool_class = cls[1]
-                    break
+        from python.helpers import tool_registry
+
+        info = tool_registry.get(name)
+        tool_class = info.cls if info else Unknown
 
         return tool_class(agent=self, name=name, args=args, message=message, **kwargs)
 
-    async def fetch_memories(self, reset_skip=False):
+    def start_memory_recall(self):
         if self.config.auto_memory_count <= 0:
-            return ""
-        if reset_skip:
-            self.memory_skip_counter = 0
-
+            return
         if self.memory_skip_counter > 0:
             self.memory_skip_counter -= 1
+            return
+        self.memory_skip_counter = self.config.auto_memory_skip
+        if self.memory_task and not self.memory_task.done():
+            self.memory_task.cancel()  # superseded by newer history
+        messages = self.concat_messages(self.history)
+        self.memory_task = asyncio.create_task(self.recall_memories(messages))
+
+    async def recall_memories(self, messages: str):
+        from python.tools import memory_tool
+
+        memories = await memory_tool.search(self, messages)
+        input = {"conversation_history": messages, "raw_memories": memories}
+        cleanup_prompt = self.read_prompt("msg.memory_cleanup.md").replace(
+            "{", "{{"
+        )
+        return await self.send_adhoc_message(
+            cleanup_prompt,
+            json.dumps(input),
+            output_label="Memory injection",
+            printout=False,
+        )
+
+    async def fetch_memories(self):
+        # result of the background recall, waits at most auto_memory_deadline_seconds for it
+        # if it is not ready, the loop continues and the memories go into a later prompt
+        task = self.memory_task
+        if not task:
             return ""
-        else:
-            self.memory_skip_counter = self.config.auto_memory_skip
-            from python.tools import memory_tool
-
-            messages = self.concat_messages(self.history)
-            memories = memory_tool.search(self, messages)
-            input = {"conversation_history": messages, "raw_memories": memories}
-            cleanup_prompt = self.read_prompt("msg.memory_cleanup.md").replace(
-                "{", "{{"
-            )
-            clean_memories = await self.send_adhoc_message(
-                cleanup_prompt, json.dumps(input), output_label="Memory injection"
-            )
-            return clean_memories
+        if not task.done():
+            await asyncio.wait([task], timeout=self.config.auto_memory_deadline_seconds)
+            if not task.done():
+                return ""
+        self.memory_task = None
+        if task.cancelled():
+            return ""
+        try:
+            return task.result()
+        except Exception as e:  # failed recall should not break the conversation
+            error_message = errors.format_error(e)
+            PrintStyle(font_color="red", padding=True).print(error_message)
+            self.context.log.log(type="error", content=error_message)
+            return ""
+
+    def is_tool_request_complete(self, parser: DirtyJsonStream):
+        return (
+            parser.done
+            and isinstance(parser.result, dict)
+            and bool(parser.result.get("tool_name") or parser.result.get("tool_calls"))
+        )
 
-    def log_from_stream(self, stream: str, logItem: Log.LogItem):
+    def log_from_stream(self, stream: str, chunk: str, parser: DirtyJsonStream, logItem: Log.LogItem):
         try:
-            if len(stream) < 25:
-                return  # no reason to try
-            response = DirtyJson.parse_string(stream)
-            if isinstance(response, dict):
+            response = parser.feed(chunk)  # only the new chunk is parsed
+            if isinstance(response, dict) and response:
                 logItem.update(
                     content=stream, kvps=response
                 )  # log if result is a dictionary already
@@ -30,12 +30,22 @@ def initialize():
         # prompts_subdir = "",
         # memory_subdir = "",
         # knowledge_subdir: str = ""
+        # memory_flush_seconds = 30,
+        # memory_flush_ops = 1000,
+        # memory_index_type = "hnsw", # flat, hnsw, ivf_flat or ivf_pq
+        # memory_index_promote_at = 50000,
+        # memory cache limits apply to the whole process, only the startup config sets them
+        # memory_cache_size = 8, # memory databases kept loaded, least recently used are unloaded
+        # memory_cache_idle_seconds = 1800,
+        # memory_cache_max_mb = 0, # 0 = no limit
         auto_memory_count = 0,
         # auto_memory_skip = 2,
+        # auto_memory_deadline_seconds = 1.0,
         # rate_limit_seconds = 60,
         rate_limit_requests = 15,
         # rate_limit_input_tokens = 0,
         # rate_limit_output_tokens = 0,
+        # rate_limit_weight = 1.0,
         # msgs_keep_max = 25,
         # msgs_keep_start = 5,
         # msgs_keep_end = 10,
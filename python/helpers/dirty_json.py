@@ -1,3 +1,5 @@
+import time
+
 class DirtyJson:
     def __init__(self):
         self._reset()
@@ -61,7 +63,7 @@ class DirtyJson:
         self._skip_whitespace()
         if self.current_char == '{':
             if self._peek(1) == '{':  # Handle {{
-                self._advance(2)
+                self._advance()
             return self._parse_object()
         elif self.current_char == '[':
             return self._parse_array()
@@ -99,10 +101,7 @@ class DirtyJson:
         while self.current_char is not None:
             self._skip_whitespace()
             if self.current_char == '}':
-                if self._peek(1) == '}':  # Handle }}
-                    self._advance(2)
-                else:
-                    self._advance()
+                self._advance()  # extra closing brace of {{ }} is left after the root object
                 self.stack.pop()
                 return
             if self.current_char is None:
@@ -262,3 +261,305 @@ class DirtyJson:
 
     def index_of_first_brace(self, input_str: str) -> int:
         return input_str.find("{")
+
+
+_ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', '"': '"', "'": "'", '\\': '\\', '/': '/'}
+_NUMBER_CHARS = set("0123456789+-.eE")
+_LITERALS = {"true": True, "false": False, "null": None, "undefined": None}
+# partial strings are republished after growing by this fraction or after this many seconds
+_PUBLISH_GROWTH = 0.25
+_PUBLISH_SECONDS = 0.1
+
+
+class _Frame:
+    # open object or array, state is "key", "colon", "value" or "after" (value)
+    __slots__ = ("container", "key", "state")
+
+    def __init__(self, container):
+        self.container = container
+        self.key = None
+        self.state = "key" if isinstance(container, dict) else "value"
+
+
+class _Token:
+    # scalar being read, kind is "quote", "string", "multiline", "number", "bare" or "key"
+    # text is collected in parts and joined when needed, appending never copies what has been read
+    __slots__ = ("kind", "quote", "parts", "size", "published", "escape", "unicode", "quotes", "is_key", "slot")
+
+    def __init__(self, kind: str, quote: str = "", is_key: bool = False, slot=None):
+        self.kind = kind
+        self.quote = quote
+        self.parts: list[str] = []
+        self.size = 0
+        self.published = -1  # size when the partial string was last published
+        self.escape = False
+        self.unicode: str | None = None
+        self.quotes = 1 if kind == "quote" else 0
+        self.is_key = is_key
+        self.slot = slot
+
+    def add(self, text: str):
+        if text:
+            self.parts.append(text)
+            self.size += len(text)
+
+    @property
+    def text(self) -> str:
+        if len(self.parts) > 1:
+            self.parts[:] = ["".join(self.parts)]
+        return self.parts[0] if self.parts else ""
+
+
+class DirtyJsonStream:
+    # resumable version of DirtyJson for streamed responses
+    # every chunk is consumed exactly once, partial keys and values are kept between chunks
+    # and result holds the root object parsed so far, a partial string is updated after it grows
+    # by a quarter or every 0.1 seconds, so a long string is joined a bounded number of times
+    def __init__(self):
+        self.result: dict | None = None
+        self.done = False  # root object has been closed
+        self.end = -1  # position in the stream right after the root object
+        self.pos = 0  # number of characters fed so far
+        self.stack: list[_Frame] = []
+        self.token: _Token | None = None
+        self.skip_brace = False  # handle {{ at the start of the root object
+        self.published_at = 0.0
+
+    def feed(self, chunk: str):
+        i, n = 0, len(chunk)
+        while i < n and not self.done:
+            if self.token:
+                i = self._read_token(chunk, i)
+            elif self.result is None:
+                start = chunk.find("{", i)  # skip any text up to the first brace
+                if start == -1:
+                    break
+                self.result = {}
+                self.stack.append(_Frame(self.result))
+                self.skip_brace = True
+                i = start + 1
+            else:
+                i = self._read_structure(chunk, i)
+        self._publish()
+        self.pos += n
+        return self.result
+
+    def _publish(self):
+        # make partial string visible in its container
+        token = self.token
+        if not (token and token.slot and token.kind in ("string", "multiline")) or token.size == token.published:
+            return
+        now = time.monotonic()
+        if token.size - token.published < token.published * _PUBLISH_GROWTH and now - self.published_at < _PUBLISH_SECONDS:
+            return
+        container, key = token.slot
+        container[key] = token.text
+        token.published = token.size
+        self.published_at = now
+
+    def _read_structure(self, chunk: str, i: int) -> int:
+        c = chunk[i]
+        if c.isspace():
+            return i + 1
+        if self.skip_brace:
+            self.skip_brace = False
+            if c == "{":
+                return i + 1
+        frame = self.stack[-1]
+        if isinstance(frame.container, dict):
+            if frame.state == "key":
+                if c in "}]":
+                    return self._close(i)
+                if c == ",":
+                    return i + 1
+                if c in "\"'":
+                    self.token = _Token("string", c, is_key=True)
+                    return i + 1
+                self.token = _Token("key")
+                return i
+            if frame.state == "colon":
+                if c == ":":
+                    frame.state = "value"
+                    return i + 1
+                frame.state = "value"  # missing colon, read value directly
+                return i
+            if frame.state == "value":
+                return self._start_value(chunk, i)
+            # after value
+            if c == ",":
+                frame.state = "key"
+                return i + 1
+            if c in "}]":
+                return self._close(i)
+            frame.state = "key"  # missing comma
+            return i
+        else:
+            if frame.state == "value":
+                if c in "]}":
+                    return self._close(i)
+                if c == ",":
+                    return i + 1
+                return self._start_value(chunk, i)
+            # after value
+            if c == ",":
+                frame.state = "value"
+                return i + 1
+            if c in "]}":
+                return self._close(i)
+            frame.state = "value"  # missing comma
+            return i
+
+    def _start_value(self, chunk: str, i: int) -> int:
+        c = chunk[i]
+        frame = self.stack[-1]
+        if c in "{[":
+            container = {} if c == "{" else []
+            self._set_value(container)
+            self.stack.append(_Frame(container))
+            return i + 1
+        if c in ",}]":
+            self._set_value(None)  # missing value
+            return i
+        if c in "\"'`":
+            self.token = _Token("quote", c, slot=self._set_value(""))
+            return i + 1
+        if c.isdigit() or c in "-+":
+            self.token = _Token("number")
+            return i
+        self.token = _Token("bare")
+        return i
+
+    def _set_value(self, value):
+        frame = self.stack[-1]
+        container = frame.container
+        frame.state = "after"
+        if isinstance(container, dict):
+            container[frame.key] = value
+            return (container, frame.key)
+        container.append(value)
+        return (container, len(container) - 1)
+
+    def _close(self, i: int) -> int:
+        self.stack.pop()
+        if not self.stack:
+            self.done = True
+            self.end = self.pos + i + 1
+        return i + 1
+
+    def _finish_token(self, value):
+        token = self.token
+        self.token = None
+        if token.is_key or token.kind == "key":  # type: ignore
+            frame = self.stack[-1]
+            frame.key = value
+            frame.state = "colon"
+        elif token.slot:  # type: ignore
+            container, key = token.slot  # type: ignore
+            container[key] = value
+        else:
+            self._set_value(value)
+
+    def _read_token(self, chunk: str, i: int) -> int:
+        token: _Token = self.token  # type: ignore
+        n = len(chunk)
+
+        if token.kind == "quote":
+            # opening quotes of a value, three of them start a multiline string
+            while i < n and chunk[i] == token.quote and token.quotes < 3:
+                token.quotes += 1
+                i += 1
+            if token.quotes == 3:
+                token.kind = "multiline"
+                token.quotes = 0
+            elif i < n:
+                if token.quotes == 2:
+                    self._finish_token("")  # empty string
+                else:
+                    token.kind = "string"
+            return i
+
+        if token.kind == "string":
+            while i < n:
+                if token.escape:
+                    if token.unicode is not None:
+                        take = min(4 - len(token.unicode), n - i)
+                        token.unicode += chunk[i : i + take]
+                        i += take
+                        if len(token.unicode) == 4:
+                            try:
+                                token.add(chr(int(token.unicode, 16)))
+                            except ValueError:
+                                token.add("\\u" + token.unicode)
+                            token.unicode = None
+                            token.escape = False
+                        continue
+                    c = chunk[i]
+                    i += 1
+                    if c == "u":
+                        token.unicode = ""
+                        continue
+                    token.add(_ESCAPES.get(c, "\\" + c))
+                    token.escape = False
+                    continue
+                end = chunk.find(token.quote, i)
+                slash = chunk.find("\\", i, end if end != -1 else n)
+                if slash != -1:
+                    token.add(chunk[i:slash])
+                    token.escape = True
+                    i = slash + 1
+                elif end != -1:
+                    token.add(chunk[i:end])
+                    self._finish_token(token.text)
+                    return end + 1
+                else:
+                    token.add(chunk[i:])
+                    return n
+            return i
+
+        if token.kind == "multiline":
+            while i < n:
+                if chunk[i] == token.quote:
+                    token.quotes += 1
+                    i += 1
+                    if token.quotes == 3:
+                        self._finish_token(token.text.strip())
+                        return i
+                    continue
+                if token.quotes:
+                    token.add(token.quote * token.quotes)
+                    token.quotes = 0
+                end = chunk.find(token.quote, i)
+                end = n if end == -1 else end
+                token.add(chunk[i:end])
+                i = end
+            return i
+
+        if token.kind == "number":
+            start = i
+            while i < n and chunk[i] in _NUMBER_CHARS:
+                i += 1
+            token.add(chunk[start:i])
+            if i < n:
+                try:
+                    value = int(token.text)
+                except ValueError:
+                    try:
+                        value = float(token.text)
+                    except ValueError:
+                        value = token.text
+                self._finish_token(value)
+            return i
+
+        # unquoted key or value
+        stops = ":,}]" if token.kind == "key" else ",}]"
+        start = i
+        while i < n and chunk[i] not in stops and not (token.kind == "key" and chunk[i].isspace()):
+            i += 1
+        token.add(chunk[start:i])
+        if i < n:
+            text = token.text.strip()
+            if token.kind == "key":
+                self._finish_token(text)
+            else:
+                self._finish_token(_LITERALS[text.lower()] if text.lower() in _LITERALS else text)
+        return i
@@ -0,0 +1,178 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Any, Iterator, Optional, Sequence
+from langchain_core.documents import Document
+
+# sqlite limits the number of bound variables per statement
+BATCH_SIZE = 500
+MAX_QUERY_TERMS = 64
+
+# too common to tell documents apart, left out of keyword queries
+STOPWORDS = frozenset("""
+a about above after again all am an and any are as at be because been before being below between both but by can could did do does doing
+down during each few for from further had has have having he her here hers him his how i if in into is it its itself just me more most my
+no nor not now of off on once only or other our ours out over own same she should so some such than that the their theirs them then there
+these they this those through to too under until up very was we were what when where which while who whom why will with would you your yours
+""".split())
+
+# metadata copied to indexed columns for filtered searches, timestamp is filtered with "after" and "before"
+FILTER_FIELDS = ["source", "type", "area"]
+FILTERS = FILTER_FIELDS + ["after", "before"]
+
+# bm25 keyword index kept in sync with the docs table by triggers
+# underscores are part of words so identifiers like ERR_CONN_REFUSED stay one token
+LEXICAL_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(text, content='docs', content_rowid='pk', tokenize="unicode61 tokenchars '_'");
+CREATE TRIGGER IF NOT EXISTS docs_ai AFTER INSERT ON docs BEGIN
+    INSERT INTO docs_fts(rowid, text) VALUES (new.pk, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS docs_ad AFTER DELETE ON docs BEGIN
+    INSERT INTO docs_fts(docs_fts, rowid, text) VALUES ('delete', old.pk, old.text);
+END;
+CREATE TRIGGER IF NOT EXISTS docs_au AFTER UPDATE ON docs BEGIN
+    INSERT INTO docs_fts(docs_fts, rowid, text) VALUES ('delete', old.pk, old.text);
+    INSERT INTO docs_fts(rowid, text) VALUES (new.pk, new.text);
+END;
+"""
+
+
+class SQLiteDocstore:
+    # documents of a VectorDB on disk, fetched by id when search results need them
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS docs (pk INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, text TEXT NOT NULL, metadata TEXT NOT NULL, source TEXT, type TEXT, area TEXT, timestamp REAL)")
+        for field in FILTER_FIELDS + ["timestamp"]:
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS docs_{field} ON docs ({field})")
+        self.conn.commit()
+        self.lexical = self._create_lexical_index()
+
+    def _create_lexical_index(self) -> bool:
+        try:
+            exists = self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'docs_fts'").fetchone()
+            self.conn.executescript(LEXICAL_SCHEMA)
+            if not exists:
+                self.conn.execute("INSERT INTO docs_fts(docs_fts) VALUES ('rebuild')")
+                self.conn.commit()
+            return True
+        except sqlite3.OperationalError: # sqlite built without fts5, keyword search finds nothing
+            return False
+
+    def add(self, docs: dict[str, Document]):
+        rows = [
+            (id, doc.page_content, json.dumps(doc.metadata, default=str), *(_column(doc.metadata.get(field)) for field in FILTER_FIELDS), _timestamp(doc.metadata.get("timestamp")))
+            for id, doc in docs.items()
+        ]
+        with self.lock, self.conn:
+            self.conn.executemany("""INSERT INTO docs (id, text, metadata, source, type, area, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET text = excluded.text, metadata = excluded.metadata, source = excluded.source,
+                type = excluded.type, area = excluded.area, timestamp = excluded.timestamp""", rows)
+
+    def mget(self, ids: Sequence[str]) -> list[Optional[Document]]:
+        found: dict[str, Document] = {}
+        with self.lock:
+            for i in range(0, len(ids), BATCH_SIZE):
+                batch = list(ids[i : i + BATCH_SIZE])
+                rows = self.conn.execute(f"SELECT id, text, metadata FROM docs WHERE id IN ({','.join('?' * len(batch))})", batch)
+                for id, text, metadata in rows:
+                    found[id] = Document(text, metadata=json.loads(metadata))
+        return [found.get(id) for id in ids]
+
+    def delete(self, ids: Sequence[str]):
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM docs WHERE id = ?", [(id,) for id in ids])
+
+    def search_text(self, query: str, k: int, filter: dict | None = None) -> list[str]:
+        # ids of the best bm25 keyword matches, documents matching any of the query words except stopwords count
+        terms = list(dict.fromkeys(term for term in re.findall(r"\w+", query.lower()) if term not in STOPWORDS))[:MAX_QUERY_TERMS]
+        if not self.lexical or not terms or k <= 0:
+            return []
+        match = " OR ".join(f'"{term}"' for term in terms)
+        where, args = filter_sql(filter or {})
+        with self.lock:
+            rows = self.conn.execute(f"SELECT docs.id FROM docs_fts JOIN docs ON docs.pk = docs_fts.rowid WHERE docs_fts MATCH ? AND {where} ORDER BY docs_fts.rank LIMIT ?", (match, *args, k)).fetchall()
+        return [id for (id,) in rows]
+
+    def filter_ids(self, filter: dict) -> list[str]:
+        # ids of documents with matching metadata, from the column indexes
+        where, args = filter_sql(filter)
+        with self.lock:
+            rows = self.conn.execute(f"SELECT id FROM docs WHERE {where}", args).fetchall()
+        return [id for (id,) in rows]
+
+    def ids(self) -> Iterator[str]:
+        with self.lock:
+            rows = self.conn.execute("SELECT id FROM docs").fetchall()
+        for (id,) in rows:
+            yield id
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def filter_sql(filter: dict) -> tuple[str, list]:
+    # where clause for a filter like {"area": "knowledge", "source": ["a.md", "*.pdf"], "after": "2024-05-01"}
+    # lists match any of their values, a source without wildcards matches the whole path or its end
+    if not isinstance(filter, dict):
+        raise ValueError(f"Filter must be an object like {{\"area\": \"main\"}}, not {type(filter).__name__}")
+    clauses: list[str] = []
+    args: list[Any] = []
+    for key, value in filter.items():
+        if key not in FILTERS:
+            raise ValueError(f"Unknown filter '{key}', use one of {', '.join(FILTERS)}")
+        if key == "after":
+            clauses.append("timestamp >= ?")
+            args.append(_timestamp(value))
+        elif key == "before":
+            clauses.append("timestamp < ?")
+            args.append(_timestamp(value))
+        else:
+            values = [str(v) for v in (value if isinstance(value, (list, tuple, set)) else [value])]
+            if key == "source":
+                parts = []
+                for v in values:
+                    if any(c in v for c in "*?["):
+                        parts.append("source GLOB ?")
+                        args.append(v)
+                    else:
+                        parts.append("source = ? OR source GLOB ?")
+                        args += [v, "*/" + v]
+                clauses.append(f"({' OR '.join(parts) or '0'})")
+            else:
+                clauses.append(f"{key} IN ({','.join('?' * len(values))})")
+                args += values
+    return " AND ".join(clauses) or "1", args
+
+def check_filter(filter: dict | None):
+    # raises ValueError for filters that cannot be searched with, before any work is done
+    if filter is not None:
+        filter_sql(filter)
+
+def _column(value: Any) -> str | None:
+    return None if value is None else str(value)
+
+def _timestamp(value: Any) -> float | None:
+    # seconds since the epoch, from a number or an ISO date
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.timestamp()
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        raise ValueError(f"Invalid date '{value}', use an ISO date like 2024-05-01 or 2024-05-01T14:30")
@@ -0,0 +1,76 @@
+import os
+import shutil
+import sqlite3
+import threading
+from typing import Iterator, Optional, Sequence
+from langchain_core.stores import ByteStore
+
+# sqlite limits the number of bound variables per statement
+BATCH_SIZE = 500
+
+
+class SQLiteByteStore(ByteStore):
+    # cached embeddings in a single sqlite file instead of one file per vector like LocalFileStore
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID")
+        self.conn.commit()
+
+    def mget(self, keys: Sequence[str]) -> list[Optional[bytes]]:
+        found: dict[str, bytes] = {}
+        with self.lock:
+            for i in range(0, len(keys), BATCH_SIZE):
+                batch = list(keys[i : i + BATCH_SIZE])
+                rows = self.conn.execute(f"SELECT key, value FROM kv WHERE key IN ({','.join('?' * len(batch))})", batch)
+                found.update(rows)
+        return [found.get(key) for key in keys]
+
+    def mset(self, key_value_pairs: Sequence[tuple[str, bytes]]) -> None:
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", key_value_pairs)
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM kv WHERE key = ?", [(key,) for key in keys])
+
+    def yield_keys(self, *, prefix: Optional[str] = None) -> Iterator[str]:
+        with self.lock:
+            if prefix:
+                rows = self.conn.execute("SELECT key FROM kv WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)).fetchall()
+            else:
+                rows = self.conn.execute("SELECT key FROM kv").fetchall()
+        for (key,) in rows:
+            yield key
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def migrate_local_file_store(store: ByteStore, directory: str, batch_size: int = 1000) -> int:
+    # moves embeddings cached by LocalFileStore into the store, the directory is removed when done
+    # safe to run again after an interruption, already copied keys are just overwritten
+    if not os.path.isdir(directory):
+        return 0
+    count = 0
+    batch: list[tuple[str, bytes]] = []
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            key = os.path.relpath(path, directory).replace(os.sep, "/")
+            with open(path, "rb") as f:
+                batch.append((key, f.read()))
+            if len(batch) >= batch_size:
+                store.mset(batch)
+                count += len(batch)
+                batch = []
+    if batch:
+        store.mset(batch)
+        count += len(batch)
+    shutil.rmtree(directory)
+    return count
@@ -14,6 +14,13 @@ def json_parse_dirty(json:str) -> dict[str,Any] | None:
         if isinstance(data,dict): return data
     return None
 
+def get_tool_calls(tool_request: dict[str,Any]) -> list[tuple[str, Any]]:
+    # one tool in tool_name and tool_args, or a list of them in tool_calls
+    calls = tool_request.get("tool_calls")
+    if isinstance(calls, list) and calls:
+        return [(call.get("tool_name", ""), call.get("tool_args", {})) for call in calls if isinstance(call, dict)]
+    return [(tool_request.get("tool_name", ""), tool_request.get("tool_args", {}))]
+
 def extract_json_object_string(content):
     start = content.find('{')
     if start == -1:
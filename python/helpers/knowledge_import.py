@@ -2,45 +2,180 @@ import glob
 import os
 import hashlib
 import json
-from typing import Any, Dict, Literal, TypedDict
+import time
+import multiprocessing
+from collections import defaultdict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Iterator, Literal, TypedDict
 from langchain_community.document_loaders import (
-    CSVLoader, JSONLoader, PyPDFLoader, TextLoader, UnstructuredHTMLLoader, 
+    CSVLoader, JSONLoader, PyPDFLoader, TextLoader, UnstructuredHTMLLoader,
     UnstructuredMarkdownLoader
 )
+from langchain_core.documents import Document
 from python.helpers import files
 from python.helpers.log import Log
 
 text_loader_kwargs = {'autodetect_encoding': True}
 
+# Mapping file extensions to corresponding loader classes
+file_types_loaders = {
+    'txt': TextLoader,
+    'pdf': PyPDFLoader,
+    'csv': CSVLoader,
+    'html': UnstructuredHTMLLoader,
+    'json': JSONLoader,
+    'md': UnstructuredMarkdownLoader
+}
+
+# files are parsed in worker processes, a file taking longer than LOAD_TIMEOUT seconds is skipped
+LOAD_WORKERS = min(4, os.cpu_count() or 1)
+LOAD_TIMEOUT = 120
+LOAD_ATTEMPTS = 2  # files running when a worker crashed are retried once, one at a time to find the culprit
+
+# xxhash is optional, hashlib's blake2b is used without it
+try:
+    import xxhash
+    HASH_TYPE = "xxh3_128"
+except ImportError:
+    HASH_TYPE = "blake2b"
+HASH_CHUNK_SIZE = 1024 * 1024
+
 
 class KnowledgeImport(TypedDict):
     file: str
     checksum: str
+    checksum_type: str # missing for entries created with md5 checksums
+    size: int
+    mtime: int # nanoseconds
+    inode: int
     ids: list[str]
+    chunks: list[str] # checksum of each chunk, aligned with ids
     state: Literal["changed", "original", "removed"]
     documents: list[Any]
 
 
-def calculate_checksum(file_path: str) -> str:
-    hasher = hashlib.md5()
+def get_hasher(hash_type: str):
+    if hash_type == "xxh3_128":
+        return xxhash.xxh3_128()
+    return hashlib.new(hash_type)
+
+def calculate_checksums(file_path: str, hash_types: list[str]) -> dict[str, str]:
+    # streams the file once for all requested hashes
+    hashers = {hash_type: get_hasher(hash_type) for hash_type in hash_types}
     with open(file_path, 'rb') as f:
-        buf = f.read()
-        hasher.update(buf)
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            for hasher in hashers.values():
+                hasher.update(chunk)
+    return {hash_type: hasher.hexdigest() for hash_type, hasher in hashers.items()}
+
+def calculate_checksum(file_path: str, hash_type: str = HASH_TYPE) -> str:
+    return calculate_checksums(file_path, [hash_type])[hash_type]
+
+def chunk_checksum(doc: Document) -> str:
+    # content and metadata, a chunk that only moved to another page gets new metadata
+    metadata = {k: v for k, v in doc.metadata.items() if k != "id"}
+    hasher = get_hasher(HASH_TYPE)
+    hasher.update(doc.page_content.encode("utf-8", "surrogatepass"))
+    hasher.update(json.dumps(metadata, sort_keys=True, default=str).encode("utf-8"))
     return hasher.hexdigest()
 
-def load_knowledge(logger: Log, knowledge_dir: str, index: Dict[str, KnowledgeImport]) -> Dict[str, KnowledgeImport]:
+def match_chunks(file_data: KnowledgeImport, exists: Callable[[str], bool] = lambda id: True) -> tuple[list[Document], list[str]]:
+    # gives new chunks identical to a previous chunk that chunk's id, sets the new chunk checksums
+    # returns the documents that need embedding and the ids that are no longer used
+    previous: dict[str, list[str]] = defaultdict(list)
+    for id, checksum in zip(file_data.get('ids', []), file_data.get('chunks', [])):
+        if exists(id):
+            previous[checksum].append(id)
+    reused: set[str] = set()
+    new_docs: list[Document] = []
+    checksums = []
+    for doc in file_data['documents']:
+        checksum = chunk_checksum(doc)
+        checksums.append(checksum)
+        if previous[checksum]:
+            doc.metadata["id"] = previous[checksum].pop()
+            reused.add(doc.metadata["id"])
+        else:
+            new_docs.append(doc)
+    file_data['chunks'] = checksums
+    return new_docs, [id for id in file_data.get('ids', []) if id not in reused]
+
+def get_file_stat(file_path: str) -> dict[str, int]:
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'inode': stat.st_ino}
+
+def is_unchanged(file_data: dict, file_stat: dict[str, int]) -> bool:
+    # same size, mtime and inode as at the last import, no need to read the file
+    return bool(file_data.get('checksum')) and all(file_data.get(key) == value for key, value in file_stat.items())
+
+def get_file_type(file_path: str) -> str:
+    # lowercase extension without the dot, selects the loader and is the "type" of knowledge chunks
+    return os.path.splitext(file_path)[1].lstrip('.').lower()
+
+def load_file(file_path: str) -> list[Document]:
+    # runs in a worker process
+    ext = get_file_type(file_path)
+    loader_cls = file_types_loaders[ext]
+    loader = loader_cls(file_path, **(text_loader_kwargs if ext in ['txt', 'csv', 'html', 'md'] else {}))
+    return loader.load_and_split()
+
+def load_files(file_paths: list[str], workers: int = LOAD_WORKERS, timeout: float = LOAD_TIMEOUT, loader: Callable[[str], list[Document]] = load_file) -> Iterator[tuple[str, list[Document] | Exception]]:
+    # yields (file path, documents or error) in the order files finish
+    # a file that times out or crashes its worker does not stop the others, the pool is restarted for them
+    pending = deque(file_paths)
+    suspects: deque[str] = deque() # files that were running when a worker crashed
+    attempts = {path: 0 for path in file_paths}
+    workers = max(1, min(workers, len(file_paths)))
+    while pending or suspects:
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        running: dict[Future, tuple[str, float]] = {}
+        try:
+            while pending or suspects or running:
+                # keep no more files in flight than workers, so the timeout counts from the start of parsing
+                while (pending or suspects) and len(running) < (1 if suspects else workers):
+                    path = suspects.popleft() if suspects else pending.popleft()
+                    attempts[path] += 1
+                    running[pool.submit(loader, path)] = (path, time.monotonic())
+
+                deadline = min(started for _, started in running.values()) + timeout
+                done, _ = wait(running, timeout=max(0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+
+                broken = False
+                for future in done:
+                    path, _ = running.pop(future)
+                    try:
+                        yield path, future.result()
+                    except BrokenProcessPool as e:
+                        broken = True
+                        if attempts[path] < LOAD_ATTEMPTS:
+                            suspects.append(path)
+                        else:
+                            yield path, e
+                    except Exception as e:
+                        yield path, e
+
+                now = time.monotonic()
+                expired = [future for future, (_, started) in running.items() if now - started >= timeout]
+                for future in expired:
+                    path, _ = running.pop(future)
+                    yield path, TimeoutError(f"Loading took more than {timeout} seconds")
+
+                if broken or expired:
+                    # stuck or dead workers cannot be reused, files still running are started again in a new pool
+                    pending.extendleft(path for path, _ in running.values())
+                    for path, _ in running.values():
+                        attempts[path] -= 1
+                    running.clear()
+                    break
+        finally:
+            for process in list(getattr(pool, "_processes", {}).values()):
+                process.terminate()
+            pool.shutdown(wait=True, cancel_futures=True)
+
+def iter_knowledge(logger: Log, knowledge_dir: str, index: Dict[str, KnowledgeImport]) -> Iterator[tuple[str, KnowledgeImport]]:
+    # updates the index in place and yields changed files as soon as their documents are loaded
     knowledge_dir = files.get_abs_path(knowledge_dir)
-    
-
-    # Mapping file extensions to corresponding loader classes
-    file_types_loaders = {
-        'txt': TextLoader,
-        'pdf': PyPDFLoader,
-        'csv': CSVLoader,
-        'html': UnstructuredHTMLLoader,
-        'json': JSONLoader,
-        'md': UnstructuredMarkdownLoader
-    }
 
     cnt_files = 0
     cnt_docs = 0
@@ -51,31 +186,49 @@ def load_knowledge(logger: Log, knowledge_dir: str, index: Dict[str, KnowledgeIm
         print(f"Found {len(kn_files)} knowledge files in {knowledge_dir}, processing...")
         logger.log(type="info", content=f"Found {len(kn_files)} knowledge files in {knowledge_dir}, processing...")
 
+    changed: dict[str, tuple[str, dict]] = {} # file path -> file key, new checksum and stat
     for file_path in kn_files:
-        ext = file_path.split('.')[-1].lower()
+        ext = get_file_type(file_path)
         if ext in file_types_loaders:
-            checksum = calculate_checksum(file_path)
             file_key = os.path.relpath(file_path, knowledge_dir)
-            
+            file_stat = get_file_stat(file_path)
+
             # Load existing data from the index or create a new entry
             file_data = index.get(file_key, {})
-            
-            if file_data.get('checksum') == checksum:
+
+            if is_unchanged(file_data, file_stat):
+                file_data['state'] = 'original'
+                continue
+
+            # hash with the current algorithm, and with the stored one if the entry is older
+            old_type = file_data.get('checksum_type', 'md5') if file_data.get('checksum') else None
+            checksums = calculate_checksums(file_path, list({HASH_TYPE, old_type} - {None}))
+            file_info = {'checksum': checksums[HASH_TYPE], 'checksum_type': HASH_TYPE, **file_stat}
+
+            if old_type and file_data.get('checksum') == checksums[old_type]:
+                file_data.update(file_info) # type: ignore
                 file_data['state'] = 'original'
             else:
-                file_data['state'] = 'changed'
-            
-            if file_data['state'] == 'changed':
-                file_data['checksum'] = checksum
-                loader_cls = file_types_loaders[ext]
-                loader = loader_cls(file_path, **(text_loader_kwargs if ext in ['txt', 'csv', 'html', 'md'] else {}))
-                file_data['documents'] = loader.load_and_split()
-                cnt_files += 1
-                cnt_docs += len(file_data['documents'])
-                # print(f"Imported {len(file_data['documents'])} documents from {file_path}")
-            
-            # Update the index
-            index[file_key] = file_data # type: ignore
+                changed[file_path] = (file_key, file_info)
+
+    for file_path, result in load_files(list(changed)):
+        file_key, file_info = changed[file_path]
+        if isinstance(result, Exception):
+            # keep the previous version if there is one, the file is tried again on next start
+            print(f"Failed to load knowledge file {file_path}: {result}")
+            logger.log(type="error", content=f"Failed to load knowledge file {file_path}: {result}")
+            if file_key in index:
+                index[file_key]['state'] = 'original'
+            continue
+
+        file_data = index.get(file_key, {})
+        file_data['state'] = 'changed'
+        file_data.update(file_info) # type: ignore
+        file_data['documents'] = result
+        index[file_key] = file_data # type: ignore
+        cnt_files += 1
+        cnt_docs += len(result)
+        yield file_key, file_data # type: ignore
 
     # loop index where state is not set and mark it as removed
     for file_key, file_data in index.items():
@@ -84,4 +237,8 @@ def load_knowledge(logger: Log, knowledge_dir: str, index: Dict[str, KnowledgeIm
 
     print(f"Processed {cnt_docs} documents from {cnt_files} files.")
     logger.log(type="info", content=f"Processed {cnt_docs} documents from {cnt_files} files.")
+
+def load_knowledge(logger: Log, knowledge_dir: str, index: Dict[str, KnowledgeImport]) -> Dict[str, KnowledgeImport]:
+    for _ in iter_knowledge(logger, knowledge_dir, index):
+        pass
     return index
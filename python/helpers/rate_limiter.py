@@ -1,7 +1,10 @@
+import asyncio
+import heapq
+import itertools
+import threading
 import time
-from collections import deque
-from dataclasses import dataclass
-from typing import List, Tuple
+from dataclasses import dataclass, field
+from typing import Any
 from .print_style import PrintStyle
 from .log import Log
 
@@ -11,57 +14,214 @@ class CallRecord:
     input_tokens: int
     output_tokens: int = 0  # Default to 0, will be set separately
 
+
+class TokenBucket:
+    # holds up to capacity units, refilled continuously so that capacity units are available per window
+    def __init__(self, capacity: int, window_seconds: float):
+        self.capacity = 0
+        self.level = 0.0
+        self.updated = time.monotonic()
+        self.configure(capacity, window_seconds)
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def configure(self, capacity: int, window_seconds: float):
+        self.refill(time.monotonic())
+        self.level = min(self.level, capacity) if self.enabled else float(capacity)
+        self.capacity = capacity
+        self.rate = capacity / window_seconds if window_seconds > 0 else float(capacity)
+
+    def refill(self, now: float):
+        if self.enabled:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        if not self.enabled:
+            return 0
+        amount = min(amount, self.capacity)  # oversized requests wait for a full bucket, not forever
+        if self.level >= amount:
+            return 0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        if self.enabled:
+            self.level -= amount  # may go negative for usage booked after the call
+
+    def utilization(self) -> float:
+        if not self.enabled:
+            return 0
+        return max(0.0, min(1.0, 1 - self.level / self.capacity))
+
+
+@dataclass(order=True)
+class _Waiter:
+    tag: float
+    seq: int
+    future: Any = field(default=None, compare=False)
+    cancelled: bool = field(default=False, compare=False)
+
+
 class RateLimiter:
-    def __init__(self, logger: Log, max_calls: int, max_input_tokens: int, max_output_tokens: int, window_seconds: int = 60):
-        self.logger = logger
-        self.max_calls = max_calls
-        self.max_input_tokens = max_input_tokens
-        self.max_output_tokens = max_output_tokens
+    # token buckets for calls, input and output tokens of one model endpoint, shared by all agents and contexts
+    # waiters are served by weighted fair queueing: FIFO for one owner (context), weighted between owners
+    def __init__(self, max_calls: int, max_input_tokens: int, max_output_tokens: int, window_seconds: int = 60, name: str = ""):
+        self.name = name
         self.window_seconds = window_seconds
-        self.call_records: deque = deque()
-
-    def _clean_old_records(self, current_time: float):
-        while self.call_records and current_time - self.call_records[0].timestamp > self.window_seconds:
-            self.call_records.popleft()
-
-    def _get_counts(self) -> Tuple[int, int, int]:
-        calls = len(self.call_records)
-        input_tokens = sum(record.input_tokens for record in self.call_records)
-        output_tokens = sum(record.output_tokens for record in self.call_records)
-        return calls, input_tokens, output_tokens
-
-    def _wait_if_needed(self, current_time: float, new_input_tokens: int):
-        while True:
-            self._clean_old_records(current_time)
-            calls, input_tokens, output_tokens = self._get_counts()
-            
-            wait_reasons = []
-            if self.max_calls > 0 and calls >= self.max_calls:
-                wait_reasons.append("max calls")
-            if self.max_input_tokens > 0 and input_tokens + new_input_tokens > self.max_input_tokens:
-                wait_reasons.append("max input tokens")
-            if self.max_output_tokens > 0 and output_tokens >= self.max_output_tokens:
-                wait_reasons.append("max output tokens")
-            
-            if not wait_reasons:
-                break
-            
-            oldest_record = self.call_records[0]
-            wait_time = oldest_record.timestamp + self.window_seconds - current_time
-            if wait_time > 0:
-                PrintStyle(font_color="yellow", padding=True).print(f"Rate limit exceeded. Waiting for {wait_time:.2f} seconds due to: {', '.join(wait_reasons)}")
-                self.logger.log("rate_limit","Rate limit exceeded",f"Rate limit exceeded. Waiting for {wait_time:.2f} seconds due to: {', '.join(wait_reasons)}")
-                time.sleep(wait_time)
-            current_time = time.time()
-
-    def limit_call_and_input(self, input_token_count: int) -> CallRecord:
-        current_time = time.time()
-        self._wait_if_needed(current_time, input_token_count)
-        new_record = CallRecord(current_time, input_token_count)
-        self.call_records.append(new_record)
-        return new_record
-
-    def set_output_tokens(self, output_token_count: int):
-        if self.call_records:
-            self.call_records[-1].output_tokens += output_token_count
+        self.calls = TokenBucket(max_calls, window_seconds)
+        self.input_tokens = TokenBucket(max_input_tokens, window_seconds)
+        self.output_tokens = TokenBucket(max_output_tokens, window_seconds)
+        self.lock = threading.Lock()
+        self.queue: list[_Waiter] = []
+        self.virtual_time = 0.0
+        self.owner_tags: dict[str, float] = {}
+        self.seq = itertools.count()
+
+    def get_limits(self) -> tuple[int, int, int, int]:
+        return self.calls.capacity, self.input_tokens.capacity, self.output_tokens.capacity, self.window_seconds
+
+    def configure(self, max_calls: int, max_input_tokens: int, max_output_tokens: int, window_seconds: int = 60):
+        with self.lock:
+            self.window_seconds = window_seconds
+            self.calls.configure(max_calls, window_seconds)
+            self.input_tokens.configure(max_input_tokens, window_seconds)
+            self.output_tokens.configure(max_output_tokens, window_seconds)
+        self._wake_head()
+
+    def _get_wait(self, new_input_tokens: int) -> tuple[float, list[str]]:
+        now = time.monotonic()
+        wait_reasons = []
+        wait_time = 0.0
+        for bucket, amount, reason in (
+            (self.calls, 1, "max calls"),
+            (self.input_tokens, new_input_tokens, "max input tokens"),
+            (self.output_tokens, 1, "max output tokens"),
+        ):
+            bucket.refill(now)
+            wait = bucket.wait_time(amount)
+            if wait > 0:
+                wait_reasons.append(reason)
+                wait_time = max(wait_time, wait)
+        return wait_time, wait_reasons
+
+    def _head(self) -> _Waiter | None:
+        while self.queue and self.queue[0].cancelled:
+            heapq.heappop(self.queue)
+        return self.queue[0] if self.queue else None
+
+    def _wake_head(self):
+        with self.lock:
+            head = self._head()
+            future = head.future if head else None
+        if future and not future.done():
+            future.get_loop().call_soon_threadsafe(_resolve, future)
+
+    def _enqueue(self, owner: str, weight: float) -> _Waiter:
+        with self.lock:
+            start = max(self.virtual_time, self.owner_tags.get(owner, 0.0))
+            tag = start + 1 / max(weight, 1e-6)
+            self.owner_tags[owner] = tag
+            waiter = _Waiter(tag, next(self.seq))
+            heapq.heappush(self.queue, waiter)
+            return waiter
+
+    def _serve(self, waiter: _Waiter, input_token_count: int):
+        heapq.heappop(self.queue)
+        self.virtual_time = waiter.tag
+        if len(self.owner_tags) > 1000:  # forget owners with no queued calls
+            self.owner_tags = {k: v for k, v in self.owner_tags.items() if v > self.virtual_time}
+        self.calls.take(1)
+        self.input_tokens.take(input_token_count)
+
+    async def acquire(self, input_token_count: int, logger: Log | None = None, owner: str = "", weight: float = 1.0) -> CallRecord:
+        loop = asyncio.get_running_loop()
+        waiter = self._enqueue(owner, weight)
+        reported = False
+        try:
+            while True:
+                with self.lock:
+                    wait_time, wait_reasons = None, []
+                    if self._head() is waiter:
+                        wait_time, wait_reasons = self._get_wait(input_token_count)
+                        if wait_time <= 0:
+                            self._serve(waiter, input_token_count)
+                            break
+                    waiter.future = loop.create_future()
+
+                if wait_time and not reported:
+                    reported = True
+                    PrintStyle(font_color="yellow", padding=True).print(f"Rate limit exceeded. Waiting for {wait_time:.2f} seconds due to: {', '.join(wait_reasons)}")
+                    if logger:
+                        logger.log("rate_limit","Rate limit exceeded",f"Rate limit exceeded. Waiting for {wait_time:.2f} seconds due to: {', '.join(wait_reasons)}")
+
+                # wait for the buckets to refill, or until woken up as the new head of the queue
+                await asyncio.wait([waiter.future], timeout=wait_time)
+        except BaseException:
+            waiter.cancelled = True
+            raise
+        finally:
+            self._wake_head()
+        return CallRecord(time.time(), input_token_count)
+
+    def set_output_tokens(self, output_token_count: int, record: CallRecord | None = None):
+        if record:
+            record.output_tokens += output_token_count
+        with self.lock:
+            self.output_tokens.take(output_token_count)
         return self
+
+    def utilization(self) -> dict[str, Any]:
+        with self.lock:
+            now = time.monotonic()
+            for bucket in (self.calls, self.input_tokens, self.output_tokens):
+                bucket.refill(now)
+            return {
+                "calls": self.calls.utilization(),
+                "input_tokens": self.input_tokens.utilization(),
+                "output_tokens": self.output_tokens.utilization(),
+                "waiting": sum(1 for w in self.queue if not w.cancelled),
+            }
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+# limiters shared by all agents and contexts in the process, keyed by model endpoint
+_limiters: dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+_conflicts: dict[str, set[tuple]] = {}  # differing limits already reported per endpoint
+
+_model_name_attrs = ["model_name", "model", "deployment_name", "repo_id"]
+_endpoint_attrs = ["openai_api_base", "base_url", "azure_endpoint", "anthropic_api_url", "groq_api_base", "endpoint_url"]
+
+
+def get_model_key(model) -> str:
+    name = next((str(v) for a in _model_name_attrs if (v := getattr(model, a, None))), "")
+    endpoint = next((str(v) for a in _endpoint_attrs if (v := getattr(model, a, None))), "")
+    return f"{type(model).__name__}:{name}@{endpoint}"
+
+
+def get_limiter(model, max_calls: int, max_input_tokens: int, max_output_tokens: int, window_seconds: int = 60) -> RateLimiter:
+    key = get_model_key(model)
+    limits = (max_calls, max_input_tokens, max_output_tokens, window_seconds)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = RateLimiter(*limits, name=key)
+        elif limiter.get_limits() != limits and limits not in _conflicts.setdefault(key, set()):
+            # the first configuration applies to the whole endpoint, other contexts cannot change it
+            _conflicts[key].add(limits)
+            PrintStyle(font_color="yellow", padding=True).print(
+                f"Rate limits {limits} for {key} ignored, the endpoint is already limited to {limiter.get_limits()} (calls, input tokens, output tokens, seconds)"
+            )
+    return limiter
+
+
+def get_utilization() -> dict[str, dict[str, Any]]:
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.name: limiter.utilization() for limiter in limiters}
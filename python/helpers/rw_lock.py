@@ -0,0 +1,62 @@
+import threading
+from contextlib import contextmanager
+
+
+class ReadWriteLock:
+    # used as a context manager it is an exclusive, reentrant write lock
+    # read() is shared between threads, waiting writers go first so that a stream of readers cannot starve them
+    # a thread holding the write lock may also read, a reader must not ask for the write lock or read again
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer: int | None = None
+        self.depth = 0
+        self.waiting_writers = 0
+
+    def acquire(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.depth += 1
+                return True
+            self.waiting_writers += 1
+            try:
+                while self.writer is not None or self.readers:
+                    self.cond.wait()
+            finally:
+                self.waiting_writers -= 1
+            self.writer = me
+            self.depth = 1
+            return True
+
+    def release(self):
+        with self.cond:
+            if self.writer != threading.get_ident():
+                raise RuntimeError("Cannot release a write lock held by another thread")
+            self.depth -= 1
+            if not self.depth:
+                self.writer = None
+                self.cond.notify_all()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+    @contextmanager
+    def read(self):
+        if self.writer == threading.get_ident():
+            yield
+            return
+        with self.cond:
+            while self.writer is not None or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
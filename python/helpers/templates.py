@@ -0,0 +1,102 @@
+import os, re, time
+from . import files
+
+# placeholders in prompt files look like {{name}}
+_placeholder = re.compile(r"\{\{(\w+)\}\}")
+
+# how often (seconds) cached files are checked for modification on disk
+CHECK_INTERVAL = 1.0
+
+
+class Template:
+    def __init__(self, text: str, mtime: float = 0):
+        self.text = text
+        self.mtime = mtime
+        self.checked = time.monotonic()
+        # split into [literal, key, literal, key, ..., literal]
+        parts = _placeholder.split(text)
+        self.literals: list[str] = parts[0::2]
+        self.keys: list[str] = parts[1::2]
+
+    def render(self, **kwargs) -> str:
+        if not self.keys or not kwargs:
+            return self.text
+        out = [self.literals[0]]
+        for key, literal in zip(self.keys, self.literals[1:]):
+            if key in kwargs:
+                out.append(str(kwargs[key]))
+            else:
+                out.append("{{" + key + "}}")  # keep unknown placeholders as they are
+            out.append(literal)
+        return "".join(out)
+
+
+class TemplateRegistry:
+    def __init__(self, *dirs: str):
+        self.dirs = [d for d in dirs if d]
+        self.templates: dict[str, Template] = {}  # absolute path -> template
+        for dir in self.dirs:
+            self._load_dir(dir)
+
+    def _load_dir(self, dir: str):
+        if not os.path.isdir(dir):
+            return
+        with os.scandir(dir) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    self._load(entry.path)
+
+    def _load(self, path: str) -> Template:
+        try:
+            mtime = os.stat(path).st_mtime
+            with open(path) as f:
+                template = Template(files.remove_code_fences(f.read()), mtime)
+        except OSError:
+            template = Template("", -1)  # remember missing files too, they are rechecked later
+        self.templates[path] = template
+        return template
+
+    def _get_file(self, path: str) -> Template:
+        template = self.templates.get(path)
+        if template is None:
+            return self._load(path)
+        now = time.monotonic()
+        if now - template.checked < CHECK_INTERVAL:
+            return template
+        template.checked = now
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = -1
+        if mtime != template.mtime:
+            return self._load(path)
+        return template
+
+    def get(self, file: str) -> Template | None:
+        # first directory with non-empty file wins
+        found = None
+        for dir in self.dirs:
+            template = self._get_file(os.path.join(dir, file))
+            if template.text:
+                return template
+            if template.mtime != -1:
+                found = found or template
+        return found
+
+    def render(self, file: str, **kwargs) -> str:
+        template = self.get(file)
+        if template is None:
+            raise FileNotFoundError(f"Prompt file not found: {file}")
+        return template.render(**kwargs)
+
+
+_registries: dict[str, TemplateRegistry] = {}
+
+
+def get_registry(prompts_subdir: str = "") -> TemplateRegistry:
+    registry = _registries.get(prompts_subdir)
+    if registry is None:
+        dirs = [files.get_abs_path("prompts", prompts_subdir)] if prompts_subdir else []
+        dirs.append(files.get_abs_path("prompts", "default"))
+        registry = _registries[prompts_subdir] = TemplateRegistry(*dirs)
+    return registry
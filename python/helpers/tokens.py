@@ -0,0 +1,96 @@
+import threading
+from typing import Callable
+
+# approximate tokens added by the chat format around each message (role, separators)
+MESSAGE_OVERHEAD = 4
+
+Tokenizer = Callable[[str], int]
+
+_tokenizer: Tokenizer | None = None
+_loader: threading.Thread | None = None
+_loader_lock = threading.Lock()
+
+
+def approximate_tokens(text: str) -> int:
+    # rough estimation used when no tokenizer is available
+    return int(len(text) / 4)
+
+
+def tiktoken_tokenizer(encoding: str = "cl100k_base") -> Tokenizer:
+    import tiktoken
+
+    enc = tiktoken.get_encoding(encoding)
+    return lambda text: len(enc.encode(text, disallowed_special=()))
+
+
+def set_tokenizer(tokenizer: Tokenizer | None):
+    # plug in a local tokenizer matching your provider, None restores the default
+    global _tokenizer, _loader
+    with _loader_lock:
+        _tokenizer = tokenizer
+        _loader = None
+
+
+def load_tokenizer() -> threading.Thread | None:
+    # loads the default tokenizer in the background, tiktoken may download its encoding on first use
+    # call at startup, until it is ready tokens are estimated
+    global _loader
+    with _loader_lock:
+        if _tokenizer is None and _loader is None:
+            _loader = threading.Thread(target=_load_default, name="tokenizer", daemon=True)
+            _loader.start()
+        return _loader
+
+
+def _load_default():
+    global _tokenizer
+    try:
+        tokenizer = tiktoken_tokenizer()
+    except Exception:
+        tokenizer = approximate_tokens  # tiktoken missing or encoding not available offline
+    if _tokenizer is None:
+        _tokenizer = tokenizer
+
+
+def get_tokenizer() -> Tokenizer:
+    # never blocks, the event loop must not wait for a download
+    if _tokenizer is None:
+        load_tokenizer()
+        return approximate_tokens
+    return _tokenizer
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    try:
+        return get_tokenizer()(text)
+    except Exception:
+        return approximate_tokens(text)
+
+
+def count_message_tokens(text: str) -> int:
+    return count_tokens(text) + MESSAGE_OVERHEAD
+
+
+class HistoryTokens:
+    # token counts cached per history message, kept in sync with agent history
+    def __init__(self):
+        self.counts: list[int] = []
+        self.total = 0
+
+    def append(self, text: str):
+        count = count_message_tokens(text)
+        self.counts.append(count)
+        self.total += count
+
+    def extend_last(self, text: str):
+        if not self.counts:
+            return self.append(text)
+        count = count_tokens(text)
+        self.counts[-1] += count
+        self.total += count
+
+    def rebuild(self, messages: list):
+        self.counts = [count_message_tokens(str(msg.content)) for msg in messages]
+        self.total = sum(self.counts)
@@ -11,6 +11,10 @@ class Response:
     
 class Tool:
 
+    # defaults of is_idempotent and is_parallel_safe, tools depending on their args override those instead
+    idempotent: bool = False  # no side effects, repeating the call with the same args is safe
+    parallel_safe: bool = False  # can run concurrently with other parallel safe tool calls
+
     def __init__(self, agent: Agent, name: str, args: dict[str,str], message: str, **kwargs) -> None:
         self.agent = agent
         self.name = name
@@ -21,6 +25,14 @@ class Tool:
     async def execute(self,**kwargs) -> Response:
         pass
 
+    @classmethod
+    def is_idempotent(cls, args: dict) -> bool:
+        return cls.idempotent
+
+    @classmethod
+    def is_parallel_safe(cls, args: dict) -> bool:
+        return cls.parallel_safe
+
     async def before_execution(self, **kwargs):
         PrintStyle(font_color="#1B4F72", padding=True, background_color="white", bold=True).print(f"{self.agent.agent_name}: Using tool '{self.name}':")
         self.log = self.agent.context.log.log(type="tool", heading=f"{self.agent.agent_name}: Using tool '{self.name}':", content="", kvps=self.args)
@@ -0,0 +1,96 @@
+import importlib, inspect, os
+from dataclasses import dataclass, field
+from typing import Any
+from . import files
+from .tool import Tool
+
+
+@dataclass
+class ToolInfo:
+    name: str
+    cls: type[Tool]
+    args: dict[str, Any] = field(default_factory=dict)  # argument name -> default value, inspect.Parameter.empty if required
+
+    def is_idempotent(self, args: dict) -> bool:
+        return self.cls.is_idempotent(args)
+
+    def is_parallel_safe(self, args: dict) -> bool:
+        return self.cls.is_parallel_safe(args)
+
+
+class ToolRegistry:
+    # maps tool names to Tool classes from python/tools
+    # the folder is listed once, modules are imported on first use and new files are picked up by folder mtime
+    def __init__(self, folder: str = "python/tools", package: str = "python.tools"):
+        self.folder = files.get_abs_path(folder)
+        self.package = package
+        self.names: set[str] = set()
+        self.tools: dict[str, ToolInfo] = {}
+        self.mtime = None
+
+    def scan(self):
+        try:
+            mtime = os.stat(self.folder).st_mtime
+        except OSError:
+            return
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        self.names = {
+            file[:-3]
+            for file in os.listdir(self.folder)
+            if file.endswith(".py") and not file.startswith("__")
+        }
+
+    def get(self, name: str) -> ToolInfo | None:
+        info = self.tools.get(name)
+        if info:
+            return info
+        if name not in self.names:
+            self.scan()  # maybe a new tool has been added
+            if name not in self.names:
+                return None
+        info = self._load(name)
+        if info:
+            self.tools[name] = info
+        return info
+
+    def all(self) -> dict[str, ToolInfo]:
+        self.scan()
+        for name in self.names:
+            self.get(name)
+        return dict(self.tools)
+
+    def _load(self, name: str) -> ToolInfo | None:
+        module = importlib.import_module(f"{self.package}.{name}")
+        classes = [
+            cls
+            for _, cls in inspect.getmembers(module, inspect.isclass)
+            if cls is not Tool and issubclass(cls, Tool)
+        ]
+        # prefer tool classes defined in the module over imported ones
+        classes.sort(key=lambda cls: cls.__module__ != module.__name__)
+        if not classes:
+            return None
+        cls = classes[0]
+        return ToolInfo(
+            name=name,
+            cls=cls,
+            args=get_args_schema(cls),
+        )
+
+
+def get_args_schema(cls: type[Tool]) -> dict[str, Any]:
+    params = inspect.signature(cls.execute).parameters.values()
+    return {
+        p.name: p.default
+        for p in params
+        if p.name != "self" and p.kind not in (p.VAR_KEYWORD, p.VAR_POSITIONAL)
+    }
+
+
+registry = ToolRegistry()
+
+
+def get(name: str) -> ToolInfo | None:
+    return registry.get(name)
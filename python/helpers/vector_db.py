@@ -1,69 +1,223 @@
-from langchain.storage import InMemoryByteStore, LocalFileStore
+from langchain.storage import InMemoryByteStore
 from langchain.embeddings import CacheBackedEmbeddings
 # from langchain_chroma import Chroma
-from langchain_community.vectorstores import FAISS
 import faiss
-from langchain_community.docstore.in_memory import InMemoryDocstore
 
-import os, json
-from . import files
+import os, json, math, time, asyncio, atexit, base64, functools, pickle, shutil, threading, weakref
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+import numpy as np
+from . import files, vector_index, embedding_cache, document_store
+from .rw_lock import ReadWriteLock
 from langchain_core.documents import Document
 import uuid
 from python.helpers import knowledge_import
 from python.helpers.log import Log
 
+# knowledge import embeds documents in batches of up to EMBED_BATCH_SIZE documents or EMBED_BATCH_CHARS characters
+EMBED_BATCH_SIZE = 64
+EMBED_BATCH_CHARS = 64000
+EMBED_CONCURRENCY = 4
+
+# a filter matching less than this share of the documents is searched exactly, ANN graphs and lists miss too much of a small subset
+FILTER_ANN_RATIO = 0.5
+
+# rough resident size of one document's entries in the position and id mappings
+ID_MAPPING_BYTES = 200
+
+# hybrid search fuses keyword (bm25) and vector rankings by reciprocal rank, 60 is the usual RRF constant
+SEARCH_MODES = ["hybrid", "vector", "keyword"]
+RRF_K = 60
+
 class VectorDB:
 
-    def __init__(self, logger: Log, embeddings_model, in_memory=False, memory_dir="./memory", knowledge_dir="./knowledge"):
+    def __init__(self, logger: Log, embeddings_model, in_memory=False, memory_dir="./memory", knowledge_dir="./knowledge", write_behind=True, flush_seconds: float = 30, flush_ops: int = 1000, index_type="hnsw", promote_at=50000, mmap=True):
         self.logger = logger
 
-        print("Initializing VectorDB...")
-        self.logger.log("info", content="Initializing VectorDB...")
-        
+        # write-behind: changes go to an append-only op log, the index files are rewritten on flush only
+        self.write_behind = write_behind
+        self.flush_seconds = flush_seconds
+        self.flush_ops = flush_ops
+        self.pending_ops = 0
+        self.flush_timer: threading.Timer | None = None
+        self.lock = ReadWriteLock() # exclusive for writes, shared for searches
+
+        # flat index until promote_at documents, then rebuilt as index_type in the background
+        if index_type not in vector_index.INDEX_TYPES:
+            raise ValueError(f"Unknown index type '{index_type}', use one of {', '.join(vector_index.INDEX_TYPES)}")
+        self.index_type = index_type
+        self.promote_at = promote_at
+        self.positions: dict[str, int] = {} # document id -> position in the faiss index
+        self.tombstones = 0 # deleted vectors still in the index, ANN indexes cannot remove them
+        self.rebuild_thread: threading.Thread | None = None
+        self.build_stats: dict = {}
+        self.search_latency = 0.0
+
+        # flat and hnsw vectors are memory-mapped from the index file and documents are read from sqlite when needed
+        # only the position -> id mapping, ivf lists and vectors added since the last flush are held in memory
+        self.mmap = mmap
+        self.index = None
+        self.index_to_docstore_id: dict[int, str] = {}
+
+        # nothing is loaded until first use or warm-up
+        self.ready = threading.Event()
+        self.open_lock = threading.Lock()
+        self.opening_thread: int | None = None
+
         self.embeddings_model = embeddings_model
+        self.embedder = None
+        self.in_memory = in_memory
+        self.namespace = getattr(embeddings_model, 'model', getattr(embeddings_model, 'model_name', "default"))
 
-        self.em_dir = files.get_abs_path(memory_dir,"embeddings")
+        self.em_dir = files.get_abs_path(memory_dir,"embeddings") # legacy LocalFileStore cache, migrated on open
+        self.em_path = files.get_abs_path(memory_dir,"embeddings.db")
         self.db_dir = files.get_abs_path(memory_dir,"database")
         self.kn_dir = files.get_abs_path(knowledge_dir) if knowledge_dir else ""
-        
-        if in_memory:
-            self.store = InMemoryByteStore()
-        else:
-            self.store = LocalFileStore(self.em_dir)
+        self.oplog_path = os.path.join(self.db_dir, "oplog.jsonl")
+        self.info_path = os.path.join(self.db_dir, "embeddings.json") # embedding dimension, known without calling the model
+        self.index_path = os.path.join(self.db_dir, "index.faiss")
+        self.ids_path = os.path.join(self.db_dir, "index_ids.json") # document id of each index position, null for deleted
+        _instances.add(self)
+
+    def open(self):
+        # loads the index and imports knowledge once, callers wait while another thread is doing it
+        if self.ready.is_set() or self.opening_thread == threading.get_ident():
+            return self
+        with self.open_lock:
+            if self.ready.is_set():
+                return self
+            self.opening_thread = threading.get_ident()
+            try:
+                self._open()
+                self.ready.set()
+            finally:
+                self.opening_thread = None
+        return self
+
+    def unload(self) -> bool:
+        # flushes and releases the index and documents, the next use opens them again
+        # a database that is still rebuilding its index is kept
+        with self.open_lock, self.lock:
+            if not self.ready.is_set() or self.rebuild_thread:
+                return False
+            self.flush()
+            self.ready.clear()
+            self.index = None
+            self.index_to_docstore_id = {}
+            self.positions = {}
+            self.tombstones = 0
+            self.docstore = None # closed when the last search using it is done
+            return True
+
+    @contextmanager
+    def _loaded(self, write=True):
+        # the lock on an opened database, opens it again if it was unloaded before the lock was acquired
+        while True:
+            self.open()
+            with (self.lock if write else self.lock.read()):
+                if self.ready.is_set() or self.opening_thread == threading.get_ident():
+                    yield
+                    return
+
+    def memory_usage(self) -> int:
+        # rough estimate of the bytes held in memory, mapped vectors and documents on disk are not counted
+        if not self.ready.is_set() or self.index is None:
+            return 0
+        return vector_index.get_memory_size(self.index) + len(self.positions) * ID_MAPPING_BYTES
 
+    def _open(self):
+        print("Initializing VectorDB...")
+        self.logger.log("info", content="Initializing VectorDB...")
+
+        # the embedding cache stays open when the database is unloaded
+        if self.embedder is None:
+            if self.in_memory:
+                self.store = InMemoryByteStore()
+            else:
+                self.store = embedding_cache.SQLiteByteStore(self.em_path)
+                migrated = embedding_cache.migrate_local_file_store(self.store, self.em_dir)
+                if migrated:
+                    self.logger.log("info", content=f"Migrated {migrated} cached embeddings to {self.em_path}.")
 
-        #here we setup the embeddings model with the chosen cache storage
-        self.embedder = CacheBackedEmbeddings.from_bytes_store(
-            embeddings_model, 
-            self.store, 
-            namespace=getattr(embeddings_model, 'model', getattr(embeddings_model, 'model_name', "default")) )
+            #here we setup the embeddings model with the chosen cache storage
+            self.embedder = CacheBackedEmbeddings.from_bytes_store(
+                self.embeddings_model, 
+                self.store, 
+                namespace=self.namespace )
 
         # self.db = Chroma(
         #     embedding_function=self.embedder,
         #     persist_directory=db_dir)
 
-        
+        self.docstore = document_store.SQLiteDocstore(os.path.join(self.db_dir, "docs.db"))
+        if files.exists(self.db_dir, "index.pkl"):
+            self._migrate_pickle()
+
         # if db folder exists and is not empty:
-        if os.path.exists(self.db_dir) and files.exists(self.db_dir,"index.faiss"):
-            self.db = FAISS.load_local(
-                folder_path=self.db_dir,
-                embeddings=self.embedder,
-                allow_dangerous_deserialization=True
-            )
+        if files.exists(self.db_dir, "index.faiss"):
+            self.index = vector_index.read_index(self.index_path, self.mmap)
+            with open(self.ids_path, "r") as f:
+                self.index_to_docstore_id = {pos: id for pos, id in enumerate(json.load(f)) if id is not None}
         else:
-            index = faiss.IndexFlatL2(len(self.embedder.embed_query("example text")))
+            # without a known dimension the index is created with the first inserted vectors
+            dimension = self._load_dimension()
+            self.index = faiss.IndexFlatL2(dimension) if dimension else None
+
+        self.prepare_index()
+        if self.index is not None: self._save_dimension(self.index.d)
 
-            self.db = FAISS(
-                embedding_function=self.embedder,
-                index=index,
-                docstore=InMemoryDocstore(),
-                index_to_docstore_id={})
+        # recover changes that were not flushed before the last shutdown
+        self.replay_oplog()
+        self._reconcile()
+        self._check_index()
 
         #preload knowledge files
         if self.kn_dir:
             self.preload_knowledge(self.kn_dir, self.db_dir)
         
 
+    def _migrate_pickle(self):
+        # documents saved by langchain FAISS.save_local are moved to the sqlite docstore once
+        pkl_path = os.path.join(self.db_dir, "index.pkl")
+        with open(pkl_path, "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        docs = {id: docstore.search(id) for id in index_to_docstore_id.values()}
+        docs = {id: doc for id, doc in docs.items() if isinstance(doc, Document)}
+        for doc in docs.values():
+            # metadata for filters, set on new documents since: knowledge chunks are the ones with a source file
+            source = doc.metadata.get("source")
+            doc.metadata.setdefault("area", "knowledge" if source else "main")
+            if source: doc.metadata.setdefault("type", knowledge_import.get_file_type(str(source)))
+        self.docstore.add(docs)
+        size = max(index_to_docstore_id, default=-1) + 1
+        self._write_ids(self.ids_path, index_to_docstore_id, size)
+        os.remove(pkl_path)
+        self.logger.log("info", content=f"Migrated {len(docs)} memory documents to {self.docstore.path}.")
+
+    def _reconcile(self):
+        # documents are written at once, vectors on flush, a crash in between can leave either without the other
+        stored = set(self.docstore.ids())
+        orphans = [id for id in stored if id not in self.positions]
+        if orphans: self.docstore.delete(orphans)
+        missing = [id for id in self.positions if id not in stored]
+        deleted = self._delete(missing)
+        if deleted: self._commit({"op": "delete", "ids": deleted})
+
+    def _load_dimension(self) -> int | None:
+        if not os.path.exists(self.info_path):
+            return None
+        with open(self.info_path, "r") as f:
+            info = json.load(f)
+        return info["dimension"] if info.get("embeddings") == self.namespace else None
+
+    def _save_dimension(self, dimension: int):
+        if self._load_dimension() == dimension:
+            return
+        os.makedirs(self.db_dir, exist_ok=True)
+        with open(self.info_path, "w") as f:
+            json.dump({"embeddings": self.namespace, "dimension": dimension}, f)
+
     def preload_knowledge(self, kn_dir:str, db_dir:str):
 
         # Load the index file if it exists
@@ -78,13 +232,27 @@ class VectorDB:
             with open(index_path, 'r') as f:
                 index = json.load(f)
        
-        index = knowledge_import.load_knowledge(self.logger,kn_dir,index)
-        
-        for file in index:
-            if index[file]['state'] in ['changed', 'removed'] and index[file].get('ids',[]): # for knowledge files that have been changed or removed and have IDs
-                self.delete_documents_by_ids(index[file]['ids']) # remove original version
-            if index[file]['state'] == 'changed':
-                index[file]['ids'] = self.insert_documents(index[file]['documents']) # insert new version
+        # files are parsed in worker processes, their chunks are embedded while other files are still loading
+        changed: list[knowledge_import.KnowledgeImport] = []
+        old_ids: list[str] = []
+        def changed_documents():
+            for file_key, file_data in knowledge_import.iter_knowledge(self.logger, kn_dir, index):
+                changed.append(file_data)
+                # unchanged chunks of a changed file keep their ids and vectors
+                new_docs, stale_ids = knowledge_import.match_chunks(file_data, self._has)
+                old_ids.extend(stale_ids)
+                for doc in new_docs: # set after matching, chunk checksums do not depend on them
+                    doc.metadata.update(area="knowledge", type=knowledge_import.get_file_type(file_key))
+                yield from new_docs
+
+        # insert new chunks, embedded in batches across all files and persisted once
+        self.insert_documents_bulk(changed_documents())
+        for file_data in changed:
+            file_data['ids'] = [doc.metadata["id"] for doc in file_data['documents']]
+
+        # remove chunks of knowledge files that have been changed or removed
+        old_ids += [id for file in index if index[file]['state'] == 'removed' for id in index[file].get('ids',[])]
+        if old_ids: self.delete_documents_by_ids(old_ids)
 
         # remove index where state="removed"
         index = {k: v for k, v in index.items() if v['state'] != 'removed'}
@@ -96,61 +264,520 @@ class VectorDB:
         with open(index_path, 'w') as f:
             json.dump(index, f)    
         
-    def search_similarity(self, query, results=3):
-        return self.db.similarity_search(query,results)
+    # searches take an optional metadata filter, see document_store.filter_sql
+
+    def search_similarity(self, query, results=3, filter=None):
+        self.open()
+        vector = self.embedder.embed_query(query)
+        with self._loaded(write=False):
+            return self._docs(self._search(vector, results, self._allowed(filter)))
     
-    def search_similarity_threshold(self, query, results=3, threshold=0.5):
-        return self.db.search(query, search_type="similarity_score_threshold", k=results, score_threshold=threshold)
+    def search_similarity_threshold(self, query, results=3, threshold=0.5, filter=None):
+        self.open()
+        vector = self.embedder.embed_query(query)
+        with self._loaded(write=False):
+            return self._docs(self._search_within(vector, results, threshold, self._allowed(filter)))
 
-    def search_max_rel(self, query, results=3):
-        return self.db.max_marginal_relevance_search(query,results)
+    def search_hybrid(self, query, results=3, threshold=0.0, mode="hybrid", filter=None):
+        # vector and keyword matches above threshold, "keyword" mode does not embed the query and ignores the threshold
+        self.open()
+        # the keyword search runs while the query is embedded and the index searched
+        lexical = self._keyword_search(query, results * 2, mode, filter)
+        vector = self.embedder.embed_query(query) if mode != "keyword" else None
+        return self._hybrid(query, lexical, vector, results, threshold, mode, filter)
 
-    def delete_documents_by_query(self, query:str, threshold=0.1):
-        k = 100
-        tot = 0
-        while True:
-            # Perform similarity search with score
-            docs = self.search_similarity_threshold(query, results=k, threshold=threshold)
-
-            # Extract document IDs and filter based on score
-            # document_ids = [result[0].metadata["id"] for result in docs if result[1] < score_limit]
-            document_ids = [result.metadata["id"] for result in docs]
-            
-
-            # Delete documents with IDs over the threshold score
-            if document_ids:
-                # fnd = self.db.get(where={"id": {"$in": document_ids}})
-                # if fnd["ids"]: self.db.delete(ids=fnd["ids"])
-                # tot += len(fnd["ids"])
-                self.db.delete(ids=document_ids)
-                tot += len(document_ids)
-                                    
-            # If fewer than K document IDs, break the loop
-            if len(document_ids) < k:
-                break
-
-        if tot: self.db.save_local(folder_path=self.db_dir) # persist
-        return tot
+    def search_max_rel(self, query, results=3, fetch_k=20, lambda_mult=0.5, vector=None, filter=None):
+        # vector is the already embedded query, if the caller has it
+        self.open()
+        if vector is None: vector = self.embedder.embed_query(query)
+        with self._loaded(write=False):
+            hits = self._search(vector, fetch_k, self._allowed(filter))
+            if not hits: return []
+            vectors = self._get_vectors([pos for pos, _ in hits]) # candidates straight from the index
+            selected = max_marginal_relevance(np.asarray(vector, dtype=np.float32), vectors, k=results, lambda_mult=lambda_mult)
+            return self._docs([hits[i] for i in selected])
+
+    def delete_documents_by_query(self, query:str, threshold=0.1, filter=None):
+        self.open()
+        return self._delete_matching(self.embedder.embed_query(query), threshold, filter)
 
     def delete_documents_by_ids(self, ids:list[str]):
-        # pre = self.db.get(ids=ids)["ids"]
-        self.db.delete(ids=ids)
-        # post = self.db.get(ids=ids)["ids"]
-        #TODO? compare pre and post
-        if ids: self.db.save_local(folder_path=self.db_dir) #persist
-        return len(ids)
+        self.open()
+        with self._loaded():
+            deleted = self._delete(ids)
+            if deleted: self._commit({"op": "delete", "ids": deleted}) #persist
+        return len(deleted)
         
     def insert_text(self, text):
-        id = str(uuid.uuid4())
-        self.db.add_documents(documents=[ Document(text, metadata={"id": id}) ], ids=[id])
-        self.db.save_local(folder_path=self.db_dir) #persist
-        return id
+        return self.insert_documents([Document(text)])[0]
     
     def insert_documents(self, docs:list[Document]):
+        self.open()
+        if not docs: return []
+        ids = self._assign_ids(docs)
+        vectors = self.embedder.embed_documents([doc.page_content for doc in docs]) # embedding does not need the lock
+        return self._insert(docs, vectors, ids)
+
+    # async versions for the agent event loop: embeddings use the model's async methods,
+    # index and document work runs on a dedicated thread pool, writes are serialized per database and reads run concurrently
+
+    async def aopen(self):
+        if not self.ready.is_set():
+            await self._arun(self.open)
+        return self
+
+    async def asearch(self, query, results=3, threshold=0.0, mode="hybrid", filter=None):
+        await self.aopen()
+        lexical = self._keyword_search(query, results * 2, mode, filter)
+        vector = await self.embedder.aembed_query(query) if mode != "keyword" else None
+        return await self._arun(self._hybrid, query, lexical, vector, results, threshold, mode, filter)
+
+    async def ainsert(self, docs: list[Document]) -> list[str]:
+        await self.aopen()
+        if not docs: return []
+        ids = self._assign_ids(docs)
+        vectors = await self.embedder.aembed_documents([doc.page_content for doc in docs])
+        return await self._arun(self._insert, docs, vectors, ids)
+
+    async def adelete(self, ids: list[str]) -> int:
+        await self.aopen()
+        return await self._arun(self.delete_documents_by_ids, ids)
+
+    async def adelete_by_query(self, query: str, threshold=0.1, filter=None) -> int:
+        await self.aopen()
+        vector = await self.embedder.aembed_query(query)
+        return await self._arun(self._delete_matching, vector, threshold, filter)
+
+    async def _arun(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(_executor, functools.partial(func, *args))
+
+    def _keyword_search(self, query: str, k: int, mode: str, filter: dict | None) -> Future | None:
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode '{mode}', use one of {', '.join(SEARCH_MODES)}")
+        docstore = self.docstore
+        return _lexical_pool.submit(docstore.search_text, query, k, filter) if mode != "vector" and docstore else None
+
+    def _hybrid(self, query, lexical: Future | None, vector, results: int, threshold: float, mode: str, filter: dict | None = None) -> list[Document]:
+        fetch = results * 2
+        with self._loaded(write=False):
+            rankings = []
+            if vector is not None:
+                rankings.append([pos for pos, _ in self._search_within(vector, fetch, threshold, self._allowed(filter))])
+            if mode != "vector":
+                ids = lexical.result() if lexical else self.docstore.search_text(query, fetch, filter) # type: ignore
+                positions = [self.positions[id] for id in ids if id in self.positions]
+                rankings.append(self._relevant(vector, positions, threshold) if vector is not None else positions)
+            return self._docs([(pos, 0.0) for pos in reciprocal_rank_fusion(rankings)[:results]])
+
+    def _delete_matching(self, vector, threshold: float, filter: dict | None = None) -> int:
+        with self._loaded():
+            # every match in one exhaustive pass, removed and persisted at once
+            hits = self._range_search(vector, threshold, exhaustive=True, allowed=self._allowed(filter))
+            return self.delete_documents_by_ids([self.index_to_docstore_id[pos] for pos, _ in hits])
+
+    def _assign_ids(self, docs: list[Document]) -> list[str]:
         ids = [str(uuid.uuid4()) for _ in range(len(docs))]
-        for doc, id in zip(docs, ids): doc.metadata["id"] = id  #add ids to documents metadata
-        self.db.add_documents(documents=docs, ids=ids)
-        self.db.save_local(folder_path=self.db_dir) #persist
+        now = time.time()
+        for doc, id in zip(docs, ids):
+            doc.metadata["id"] = id  #add ids to documents metadata
+            doc.metadata.setdefault("timestamp", now)
+        return ids
+
+    def _insert(self, docs: list[Document], vectors, ids: list[str]) -> list[str]:
+        texts = [doc.page_content for doc in docs]
+        metadatas = [doc.metadata for doc in docs]
+        vectors = np.array(vectors, dtype=np.float32)
+        with self._loaded():
+            self._add(texts, vectors, metadatas, ids)
+            self._commit({"op": "add", "ids": ids, "texts": texts, "metadatas": metadatas, "vectors": encode_vectors(vectors)}) #persist
+        return ids
+
+    def insert_documents_bulk(self, docs: Iterable[Document], batch_size=EMBED_BATCH_SIZE, batch_chars=EMBED_BATCH_CHARS, concurrency=EMBED_CONCURRENCY) -> list[str]:
+        self.open()
+        # embeds batches concurrently while the documents are still being produced, adds each batch as it is embedded
+        # nothing goes to the op log, the index is persisted once at the end
+        ids: list[str] = []
+
+        def embed(batch: list[Document]):
+            return batch, np.array(self.embedder.embed_documents([doc.page_content for doc in batch]), dtype=np.float32)
+
+        def store(future: Future):
+            batch, vectors = future.result()
+            with self._loaded():
+                self._add([doc.page_content for doc in batch], vectors, [doc.metadata for doc in batch], [doc.metadata["id"] for doc in batch])
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="embed") as pool:
+            pending: set[Future] = set()
+            for batch in batch_documents(docs, batch_size, batch_chars):
+                ids += self._assign_ids(batch)
+                pending.add(pool.submit(embed, batch))
+                if len(pending) >= concurrency * 2: # bound the number of embedded batches waiting in memory
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done: store(future)
+            for future in pending: store(future)
+
+        if ids:
+            with self._loaded():
+                self.pending_ops += 1
+                self.flush()
         return ids
 
+    def stats(self) -> dict:
+        self.open()
+        with self._loaded(write=False):
+            return {
+                "index_type": vector_index.get_index_type(self.index) if self.index is not None else None,
+                "documents": len(self.positions),
+                "vectors": self.index.ntotal if self.index is not None else 0,
+                "mapped": isinstance(self.index, vector_index.LayeredIndex),
+                "tombstones": self.tombstones,
+                "keyword_index": self.docstore.lexical,
+                "rebuilding": bool(self.rebuild_thread),
+                "search_latency_ms": round(self.search_latency * 1000, 3),
+                **self.build_stats,
+            }
+
+    # adding, deleting and searching is done here, so that ANN and memory-mapped indexes can keep deleted vectors as tombstones
+
+    def prepare_index(self):
+        if self.index is not None: vector_index.prepare_index(self.index)
+        self.positions = {id: pos for pos, id in self.index_to_docstore_id.items()}
+        self.tombstones = self.index.ntotal - len(self.positions) if self.index is not None else 0
+
+    def _has(self, id: str) -> bool:
+        return id in self.positions
+
+    def _docs(self, hits: list[tuple[int, float]]) -> list[Document]:
+        docs = self.docstore.mget([self.index_to_docstore_id[pos] for pos, _ in hits])
+        return [doc for doc in docs if doc is not None]
+
+    def _get_vectors(self, positions: list[int]) -> np.ndarray:
+        if not positions: return np.empty((0, self.index.d), dtype=np.float32)
+        return self.index.reconstruct_batch(np.array(positions, dtype=np.int64))
+
+    def _allowed(self, filter: dict | None) -> np.ndarray | None:
+        # sorted positions of live documents matching the metadata filter, None without a filter
+        if not filter: return None
+        ids = self.docstore.filter_ids(filter)
+        return np.sort(np.fromiter((self.positions[id] for id in ids if id in self.positions), dtype=np.int64))
+
+    def _filtered(self, allowed: np.ndarray, exhaustive=False):
+        # index and search parameters that only consider the allowed positions
+        exhaustive = exhaustive or len(allowed) < FILTER_ANN_RATIO * len(self.positions)
+        index = vector_index.get_exhaustive(self.index) if exhaustive else self.index
+        return index, vector_index.search_params(index, allowed, exhaustive)
+
+    def _search(self, vector, k: int, allowed: np.ndarray | None = None) -> list[tuple[int, float]]:
+        # nearest live documents as (position, squared L2 distance), over-fetching to skip tombstones
+        index = self.index
+        mapping = self.index_to_docstore_id
+        k = min(k, len(mapping) if allowed is None else len(allowed))
+        if k <= 0: return []
+        started = time.perf_counter()
+        query = np.array([vector], dtype=np.float32)
+        if allowed is not None:
+            # pre-filtered by the index, deleted documents are not allowed either
+            index, params = self._filtered(allowed)
+            distances, labels = index.search(query, k, params=params)
+            self._record_latency(started)
+            return [(int(pos), float(dist)) for pos, dist in zip(labels[0], distances[0]) if pos >= 0]
+        fetch = min(index.ntotal, math.ceil(k * index.ntotal / len(mapping)))
+        while True:
+            distances, labels = index.search(query, fetch)
+            hits = [(int(pos), float(dist)) for pos, dist in zip(labels[0], distances[0]) if pos in mapping]
+            if len(hits) >= k or fetch >= index.ntotal: break
+            fetch = min(index.ntotal, fetch * 2)
+        self._record_latency(started)
+        return hits[:k]
+
+    def _relevant(self, vector, positions: list[int], threshold: float) -> list[int]:
+        # positions with relevance >= threshold like _search_within, keyword hits must be as relevant as vector hits
+        if not positions: return []
+        distances = np.sum((self._get_vectors(positions) - np.asarray(vector, dtype=np.float32)) ** 2, axis=1)
+        radius = get_radius(threshold)
+        return [pos for pos, dist in zip(positions, distances) if dist < radius]
+
+    def _search_within(self, vector, k: int, threshold: float, allowed: np.ndarray | None = None) -> list[tuple[int, float]]:
+        # at most k nearest live documents with relevance >= threshold, a knn search instead of collecting the whole radius
+        radius = get_radius(threshold)
+        return [hit for hit in self._search(vector, k, allowed) if hit[1] < radius]
+
+    def _range_search(self, vector, threshold: float, exhaustive=False, allowed: np.ndarray | None = None) -> list[tuple[int, float]]:
+        # all live documents with relevance >= threshold, nearest first, for deleting every match
+        if not self.positions or (allowed is not None and not len(allowed)): return []
+        started = time.perf_counter()
+        if allowed is not None:
+            index, params = self._filtered(allowed, exhaustive)
+        else:
+            index = vector_index.get_exhaustive(self.index) if exhaustive else self.index
+            params = vector_index.search_params(index, exhaustive=exhaustive)
+        radius = get_radius(threshold)
+        _, distances, labels = index.range_search(np.array([vector], dtype=np.float32), radius, params=params)
+        mapping = self.index_to_docstore_id
+        hits = sorted(((int(pos), float(dist)) for pos, dist in zip(labels, distances) if pos in mapping), key=lambda hit: hit[1])
+        self._record_latency(started)
+        return hits
+
+    def _record_latency(self, started: float):
+        latency = time.perf_counter() - started
+        self.search_latency = 0.9 * self.search_latency + 0.1 * latency if self.search_latency else latency
+
+    def _add(self, texts: list[str], vectors: np.ndarray, metadatas: list[dict], ids: list[str]):
+        if self.index is None:
+            self.index = vector_index.create_index("flat", vectors.shape[1], 0)
+            self._save_dimension(vectors.shape[1])
+        index = self.index
+        start = index.ntotal
+        index.add(vectors)
+        self.docstore.add({id: Document(text, metadata=metadata) for text, metadata, id in zip(texts, metadatas, ids)}) # type: ignore
+        for i, id in enumerate(ids):
+            self.index_to_docstore_id[start + i] = id
+            self.positions[id] = start + i
+        self._check_index()
+
+    def _delete(self, ids: list[str]) -> list[str]:
+        ids = [id for id in dict.fromkeys(ids) if self._has(id)]
+        if not ids: return ids
+        positions = [self.positions.pop(id) for id in ids]
+        for pos in positions: del self.index_to_docstore_id[pos]
+        self.docstore.delete(ids)
+        if self.rebuild_thread or isinstance(self.index, vector_index.LayeredIndex) or vector_index.get_index_type(self.index) != "flat":
+            self.tombstones += len(positions) # positions must stay stable
+        else:
+            self.index.remove_ids(np.array(positions, dtype=np.int64))
+            self._remap(positions)
+        self._check_index()
+        return ids
+
+    def _remap(self, removed: list[int]):
+        # flat remove_ids shifts all following vectors down
+        removed_sorted = np.sort(np.array(removed, dtype=np.int64))
+        ids = list(self.index_to_docstore_id.values())
+        old = np.fromiter(self.index_to_docstore_id.keys(), dtype=np.int64, count=len(ids))
+        new = (old - np.searchsorted(removed_sorted, old)).tolist()
+        self.index_to_docstore_id = dict(zip(new, ids))
+        self.positions = dict(zip(ids, new))
+
+    def _check_index(self):
+        # start a background rebuild when the index should be promoted, converted or compacted
+        if self.rebuild_thread or self.index is None: return
+        index = self.index
+        current = vector_index.get_index_type(index)
+        live = len(self.positions)
+        target = self.index_type if current != "flat" or live >= self.promote_at else "flat"
+        if target.startswith("ivf") and live < vector_index.IVF_MIN_SIZE:
+            target = current
+        if target == current and self.tombstones <= max(1000, index.ntotal // 4):
+            return
+        self.rebuild_thread = threading.Thread(target=self._rebuild, args=(target,), daemon=True)
+        self.rebuild_thread.start()
+
+    def _rebuild(self, index_type: str, batch_size: int = 10000):
+        try:
+            with self.lock:
+                old = self.index
+                old_type = vector_index.get_index_type(old)
+                live = list(self.index_to_docstore_id.keys())
+                new = vector_index.create_index(index_type, old.d, len(live))
+                rng = np.random.default_rng()
+                train_size = vector_index.get_train_size(new, len(live))
+                train = self._get_vectors(sorted(rng.choice(live, train_size, replace=False).tolist())) if train_size else None
+                queries = self._get_vectors(sorted(rng.choice(live, min(100, len(live)), replace=False).tolist()))
+            self.logger.log("info", content=f"Rebuilding {old_type} memory index with {len(live)} documents as {index_type}...")
+            started = time.time()
+            if train is not None:
+                vector_index.train_index(new, train)
+            probe = vector_index.RecallProbe(queries)
+
+            moved: dict[int, int] = {} # old position -> new position
+            start = 0
+            while True:
+                with self.lock:
+                    if start >= self.index.ntotal:
+                        break
+                    # live vectors in batches, including vectors added since the rebuild started
+                    # self.index keeps its positions but may be re-mapped by a flush meanwhile
+                    end = min(self.index.ntotal, start + batch_size)
+                    positions = [pos for pos in range(start, end) if pos in self.index_to_docstore_id]
+                    if vector_index.is_exact_storage(old_type):
+                        vectors = self._get_vectors(positions)
+                    else:
+                        texts = [doc.page_content for doc in self.docstore.mget([self.index_to_docstore_id[pos] for pos in positions])] # type: ignore
+                    start = end
+                if not vector_index.is_exact_storage(old_type):
+                    vectors = np.array(self.embedder.embed_documents(texts), dtype=np.float32) if texts else self._get_vectors([]) # lossy codes, use cached embeddings
+                probe.add(vectors, new.ntotal)
+                moved.update(zip(positions, range(new.ntotal, new.ntotal + len(positions))))
+                new.add(vectors)
+
+            recall, latency = probe.measure(new)
+            with self.lock:
+                if start < self.index.ntotal: # vectors added after the last batch
+                    positions = [pos for pos in range(start, self.index.ntotal) if pos in self.index_to_docstore_id]
+                    moved.update(zip(positions, range(new.ntotal, new.ntotal + len(positions))))
+                    new.add(self._get_vectors(positions))
+                # documents deleted during the rebuild become tombstones of the new index
+                self.index = new
+                self.index_to_docstore_id = {moved[pos]: id for pos, id in self.index_to_docstore_id.items()}
+                self.prepare_index()
+                self.build_stats = {"build_seconds": round(time.time() - started, 2), "build_recall": round(recall, 4), "build_latency_ms": round(latency * 1000, 3)}
+                self._mark_dirty()
+            self.logger.log("info", content=f"Memory index rebuilt as {index_type}: recall@10 {recall:.3f}, {latency * 1000:.2f} ms per query.")
+        except Exception as e:
+            self.index_type = vector_index.get_index_type(self.index) # do not retry on every write
+            self.logger.log("error", content=f"Failed to rebuild memory index as {index_type}: {e}")
+        finally:
+            self.rebuild_thread = None
+
+    def _commit(self, op: dict):
+        if self.write_behind:
+            os.makedirs(self.db_dir, exist_ok=True)
+            with open(self.oplog_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(op, default=str) + "\n")
+        self._mark_dirty()
+
+    def _mark_dirty(self):
+        if not self.write_behind:
+            self._save()
+            return
+        self.pending_ops += 1
+        if self.flush_ops > 0 and self.pending_ops >= self.flush_ops:
+            self.flush()
+        elif not self.flush_timer:
+            self.flush_timer = threading.Timer(self.flush_seconds, self.flush)
+            self.flush_timer.daemon = True
+            self.flush_timer.start()
+
+    def _save(self):
+        if self.index is None: return # nothing was ever added
+        index = self.index.merged() if isinstance(self.index, vector_index.LayeredIndex) else self.index
+        if index is not self.index and self.tombstones and not self.rebuild_thread and vector_index.get_index_type(index) == "flat":
+            # unlike the mapped index, the in-memory copy can drop deleted vectors
+            dead = np.setdiff1d(np.arange(index.ntotal, dtype=np.int64), np.fromiter(self.index_to_docstore_id, dtype=np.int64))
+            index.remove_ids(dead)
+            self._remap(dead.tolist())
+            self.index = index
+            self.tombstones = 0
+        # write to a temporary folder first so a crash never leaves half written index files behind
+        tmp_dir = self.db_dir + ".tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        faiss.write_index(index, os.path.join(tmp_dir, "index.faiss"))
+        self._write_ids(os.path.join(tmp_dir, "index_ids.json"), self.index_to_docstore_id, index.ntotal)
+        os.makedirs(self.db_dir, exist_ok=True)
+        for file in os.listdir(tmp_dir):
+            os.replace(os.path.join(tmp_dir, file), os.path.join(self.db_dir, file))
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if self.mmap:
+            # same positions, the written vectors are now read from the file
+            self.index = vector_index.prepare_index(vector_index.read_index(self.index_path, mmap=True))
+
+    def _write_ids(self, path: str, index_to_docstore_id: dict[int, str], size: int):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump([index_to_docstore_id.get(pos) for pos in range(size)], f)
+        os.replace(tmp_path, path)
+
+    def flush(self):
+        with self.lock:
+            if self.flush_timer:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            if not self.pending_ops:
+                return
+            self._save()
+            if os.path.exists(self.oplog_path):
+                os.remove(self.oplog_path) # everything in the log is now in the index files
+            self.pending_ops = 0
+
+    def replay_oplog(self):
+        if not os.path.exists(self.oplog_path):
+            return
+        ops = 0
+        with self.lock:
+            with open(self.oplog_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        op = json.loads(line)
+                    except json.JSONDecodeError:
+                        break # torn write of the last op
+                    # ops may already be in the index files if the last flush did not remove the log
+                    if op["op"] == "add":
+                        new = [i for i, id in enumerate(op["ids"]) if not self._has(id)]
+                        if new:
+                            vectors = decode_vectors(op["vectors"], len(op["ids"]))[new]
+                            self._add([op["texts"][i] for i in new], vectors, [op["metadatas"][i] for i in new], [op["ids"][i] for i in new])
+                    elif op["op"] == "delete":
+                        self._delete(op["ids"])
+                    ops += 1
+            if not ops:
+                os.remove(self.oplog_path)
+                return
+            self.logger.log("info", content=f"Recovered {ops} unsaved memory operations.")
+            self.pending_ops = ops
+            self.flush()
+
+
+def batch_documents(docs: Iterable[Document], batch_size: int, batch_chars: int) -> Iterator[list[Document]]:
+    batch: list[Document] = []
+    chars = 0
+    for doc in docs:
+        if batch and (len(batch) >= batch_size or chars + len(doc.page_content) > batch_chars):
+            yield batch
+            batch, chars = [], 0
+        batch.append(doc)
+        chars += len(doc.page_content)
+    if batch:
+        yield batch
+
+def get_radius(threshold: float) -> float:
+    # relevance is 1 - distance / sqrt(2) like langchain FAISS uses for euclidean distance
+    return (1.0 - threshold) * math.sqrt(2)
+
+def reciprocal_rank_fusion(rankings: list[list[int]], k: int = RRF_K) -> list[int]:
+    scores: dict[int, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda item: scores[item], reverse=True)
+
+def max_marginal_relevance(query: np.ndarray, vectors: np.ndarray, k: int = 4, lambda_mult: float = 0.5) -> list[int]:
+    # indexes of up to k vectors similar to the query but not to each other, by cosine similarity
+    # similarities are computed once as matrices, each step only updates the max similarity to the selection
+    k = min(k, len(vectors))
+    if k <= 0: return []
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    relevance = vectors @ (query / max(float(np.linalg.norm(query)), 1e-12))
+    similarity = vectors @ vectors.T
+    selected = [int(np.argmax(relevance))]
+    redundancy = similarity[selected[0]].copy()
+    available = np.ones(len(vectors), dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < k:
+        scores = np.where(available, lambda_mult * relevance - (1 - lambda_mult) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return selected
+
+def encode_vectors(vectors: np.ndarray) -> str:
+    return base64.b64encode(np.ascontiguousarray(vectors, dtype=np.float32).tobytes()).decode()
+
+def decode_vectors(data: str, count: int) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(data), dtype=np.float32).reshape(count, -1)
+
+
+_lexical_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="keyword-search")
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="vector-db") # async API, separate so that searches never wait for their own pool
+
+# open databases, unsaved changes are flushed on shutdown
+_instances: "weakref.WeakSet[VectorDB]" = weakref.WeakSet()
+
+def flush_all():
+    for db in list(_instances):
+        try:
+            db.flush()
+        except Exception as e:
+            print(f"Failed to flush VectorDB {db.db_dir}: {e}")
 
+atexit.register(flush_all)
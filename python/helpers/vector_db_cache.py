@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable
+from python.helpers.vector_db import VectorDB
+
+
+class VectorDBCache:
+    # databases by key, at most max_size of them loaded at once, least recently used are unloaded first
+    # also unloads databases idle for max_idle_seconds and keeps the estimated memory under max_memory_mb
+    # unloaded databases stay in the cache as empty shells and reopen on next use, 0 disables a limit
+    def __init__(self, max_size: int = 8, max_idle_seconds: float = 1800, max_memory_mb: float = 0):
+        self.max_size = max_size
+        self.max_idle_seconds = max_idle_seconds
+        self.max_memory_mb = max_memory_mb
+        self.lock = threading.Lock()
+        self.dbs: dict[Hashable, VectorDB] = {}
+        self.used: OrderedDict[Hashable, float] = OrderedDict() # key -> last use, least recent first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.sweeper: threading.Thread | None = None
+
+    def configure(self, max_size: int, max_idle_seconds: float, max_memory_mb: float):
+        self.max_size = max_size
+        self.max_idle_seconds = max_idle_seconds
+        self.max_memory_mb = max_memory_mb
+
+    def get(self, key: Hashable, create: Callable[[], VectorDB]) -> VectorDB:
+        with self.lock:
+            db = self.dbs.get(key)
+            if db is None:
+                db = self.dbs[key] = create()
+            if db.ready.is_set():
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.used[key] = time.monotonic()
+            self.used.move_to_end(key)
+            victims = self._victims(keep=key)
+            self._start_sweeper()
+        self._unload(victims)
+        return db
+
+    def evict_idle(self):
+        with self.lock:
+            victims = self._victims()
+        self._unload(victims)
+
+    def stats(self) -> dict:
+        with self.lock:
+            loaded = [db for db in self.dbs.values() if db.ready.is_set()]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "loaded": len(loaded),
+                "known": len(self.dbs),
+                "memory_mb": round(sum(db.memory_usage() for db in loaded) / 2**20, 1),
+            }
+
+    def _victims(self, keep: Hashable = None) -> list[VectorDB]:
+        # least recently used first: idle ones, then as many as needed to get under the size and memory limits
+        now = time.monotonic()
+        loaded = [(key, last) for key, last in self.used.items() if self.dbs[key].ready.is_set()]
+        memory = sum(self.dbs[key].memory_usage() for key, _ in loaded)
+        count = len(loaded) + (keep is not None and not self.dbs[keep].ready.is_set()) # keep is about to be opened
+        victims = []
+        for key, last in loaded:
+            if key == keep:
+                continue
+            idle = self.max_idle_seconds > 0 and now - last >= self.max_idle_seconds
+            too_many = self.max_size > 0 and count > self.max_size
+            too_big = self.max_memory_mb > 0 and memory > self.max_memory_mb * 2**20
+            if idle or too_many or too_big:
+                victims.append(self.dbs[key])
+                memory -= self.dbs[key].memory_usage()
+                count -= 1
+        return victims
+
+    def _unload(self, victims: list[VectorDB]):
+        # flushing can take a while, done outside of the cache lock
+        for db in victims:
+            if db.unload():
+                with self.lock:
+                    self.evictions += 1
+
+    def _start_sweeper(self):
+        # unloads idle databases also when nothing is being accessed
+        if self.sweeper or self.max_idle_seconds <= 0:
+            return
+
+        def sweep():
+            while True:
+                time.sleep(max(1.0, self.max_idle_seconds / 4))
+                try:
+                    self.evict_idle()
+                except Exception as e:
+                    print(f"Failed to unload idle memory databases: {e}")
+
+        self.sweeper = threading.Thread(target=sweep, name="memory-sweeper", daemon=True)
+        self.sweeper.start()
@@ -0,0 +1,236 @@
+import math
+import time
+import faiss
+import numpy as np
+
+INDEX_TYPES = ["flat", "hnsw", "ivf_flat", "ivf_pq"]
+
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 64
+HNSW_EF_SEARCH = 64
+IVF_MIN_SIZE = 1000  # fewer vectors than this cannot train useful IVF centroids / PQ codebooks
+IVF_TRAIN_PER_LIST = 50
+PQ_MIN_TRAIN = 10000
+MMAP_FLAG = getattr(faiss, "IO_FLAG_MMAP_IFC", None)  # missing in older faiss versions
+
+
+def get_index_type(index: "faiss.Index | LayeredIndex") -> str:
+    if isinstance(index, LayeredIndex):
+        index = index.base
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+
+def is_exact_storage(index_type: str) -> bool:
+    # whether stored vectors can be reconstructed without loss
+    return index_type != "ivf_pq"
+
+
+def get_nlist(size: int) -> int:
+    return max(1, min(int(4 * math.sqrt(size)), size // 39))
+
+
+def get_pq_m(dim: int) -> int:
+    # number of PQ sub-quantizers, about 8 dimensions each, must divide the dimension
+    m = max(1, dim // 8)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def create_index(index_type: str, dim: int, size: int) -> faiss.Index:
+    # empty index of the given type, sized for about size vectors
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, HNSW_M)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    elif index_type == "ivf_flat":
+        index = faiss.index_factory(dim, f"IVF{get_nlist(size)},Flat")
+    elif index_type == "ivf_pq":
+        index = faiss.index_factory(dim, f"IVF{get_nlist(size)},PQ{get_pq_m(dim)}")
+    elif index_type == "flat":
+        index = faiss.IndexFlatL2(dim)
+    else:
+        raise ValueError(f"Unknown index type '{index_type}', use one of {', '.join(INDEX_TYPES)}")
+    return prepare_index(index)
+
+
+def prepare_index(index):
+    # search parameters and reconstruction support, also needed after loading an index
+    if isinstance(index, LayeredIndex):
+        prepare_index(index.base)
+        return index
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf:
+        ivf.nprobe = min(ivf.nlist, max(8, ivf.nlist // 16))
+        if ivf.is_trained:
+            ivf.make_direct_map()
+    return index
+
+
+def get_exhaustive(index):
+    # index that can scan all vectors, for searches that must not miss any match, use with search_params(exhaustive=True)
+    if isinstance(index, LayeredIndex):
+        return LayeredIndex(get_exhaustive(index.base), index.path, index.delta)
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.downcast_index(index.storage)  # same positions as the graph
+    return index
+
+
+def search_params(index, allowed: np.ndarray | None = None, exhaustive: bool = False):
+    # search parameters limited to the allowed positions, probing all IVF lists when exhaustive
+    if isinstance(index, LayeredIndex):
+        # one set for each layer, positions of the in-memory layer start after the mapped ones
+        split = np.searchsorted(allowed, index.base.ntotal) if allowed is not None else 0
+        return (
+            search_params(index.base, allowed[:split] if allowed is not None else None, exhaustive),
+            search_params(index.delta, allowed[split:] - index.base.ntotal if allowed is not None else None, exhaustive),
+        )
+    selector = faiss.IDSelectorBatch(allowed) if allowed is not None else None
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch) if selector else None
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nlist if exhaustive else ivf.nprobe) if selector or exhaustive else None
+    return faiss.SearchParameters(sel=selector) if selector else None
+
+
+def get_train_size(index: faiss.Index, size: int) -> int:
+    ivf = faiss.try_extract_index_ivf(index)
+    if not ivf:
+        return 0
+    train = ivf.nlist * IVF_TRAIN_PER_LIST
+    if isinstance(index, faiss.IndexIVFPQ):
+        train = max(train, PQ_MIN_TRAIN)
+    return min(size, train)
+
+
+def read_index(path: str, mmap: bool = False):
+    # a memory-mapped index is read-only, vectors added later are kept in memory until the next write
+    # only flat code storage is mapped (flat, hnsw), ivf inverted lists are still read into memory
+    # faiss versions without the flag read the whole index
+    if mmap and MMAP_FLAG is not None:
+        return LayeredIndex(faiss.read_index(path, MMAP_FLAG), path)
+    return faiss.read_index(path)
+
+
+def get_memory_size(index) -> int:
+    # bytes of vectors held in memory, mapped flat storage is not counted but ivf lists are always read into memory
+    if isinstance(index, LayeredIndex):
+        return get_memory_size(index.delta) + (get_memory_size(index.base) if faiss.try_extract_index_ivf(index.base) else 0)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf:
+        return ivf.ntotal * ivf.code_size
+    return index.ntotal * index.d * 4
+
+
+def train_index(index: faiss.Index, vectors: np.ndarray):
+    index.train(vectors)
+    prepare_index(index)
+
+
+class RecallProbe:
+    # exact top-k neighbours of sample queries, collected while vectors stream into a new index
+    def __init__(self, queries: np.ndarray, k: int = 10):
+        self.queries = queries
+        self.k = k
+        self.distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        self.labels = np.full((len(queries), k), -1, dtype=np.int64)
+
+    def add(self, vectors: np.ndarray, start: int):
+        if not len(self.queries) or not len(vectors):
+            return
+        k = min(self.k, len(vectors))
+        distances, labels = faiss.knn(self.queries, vectors, k)
+        distances = np.hstack([self.distances, distances])
+        labels = np.hstack([self.labels, labels + start])
+        order = np.argsort(distances, axis=1)[:, : self.k]
+        self.distances = np.take_along_axis(distances, order, axis=1)
+        self.labels = np.take_along_axis(labels, order, axis=1)
+
+    def measure(self, index: faiss.Index) -> tuple[float, float]:
+        # recall@k against the exact neighbours and search latency in seconds per query
+        if not len(self.queries) or not index.ntotal:
+            return 1.0, 0.0
+        started = time.perf_counter()
+        _, labels = index.search(self.queries, self.k)
+        latency = (time.perf_counter() - started) / len(self.queries)
+        hits = sum(
+            len(set(found[found >= 0]) & set(truth[truth >= 0]))
+            for found, truth in zip(labels, self.labels)
+        )
+        total = int((self.labels >= 0).sum())
+        return (hits / total if total else 1.0), latency
+
+
+class LayeredIndex:
+    # index file mapped into memory plus a flat in-memory index for vectors added since it was written
+    # positions of the in-memory vectors continue after the mapped ones
+    def __init__(self, base: faiss.Index, path: str, delta: faiss.Index | None = None):
+        self.base = base
+        self.path = path
+        self.delta = delta if delta is not None else faiss.IndexFlatL2(base.d)
+
+    @property
+    def d(self) -> int:
+        return self.base.d
+
+    @property
+    def ntotal(self) -> int:
+        return self.base.ntotal + self.delta.ntotal
+
+    def _layers(self, params=None):
+        # (index, search parameters, position offset) of each non-empty layer
+        # params is a pair from search_params, or parameters for the mapped index only
+        base_params, delta_params = params if isinstance(params, tuple) else (params, None)
+        layers = [(self.base, base_params, 0), (self.delta, delta_params, self.base.ntotal)]
+        return [layer for layer in layers if layer[0].ntotal]
+
+    def add(self, vectors: np.ndarray):
+        self.delta.add(vectors)
+
+    def search(self, x: np.ndarray, k: int, params=None) -> tuple[np.ndarray, np.ndarray]:
+        distances = [np.empty((len(x), 0), dtype=np.float32)]
+        labels = [np.empty((len(x), 0), dtype=np.int64)]
+        for index, layer_params, offset in self._layers(params):
+            d, l = index.search(x, min(k, index.ntotal), params=layer_params)
+            distances.append(d)
+            labels.append(np.where(l >= 0, l + offset, -1))
+        distances, labels = np.hstack(distances), np.hstack(labels)
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(labels, order, axis=1)
+
+    def range_search(self, x: np.ndarray, radius: float, params=None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        results = [(index.range_search(x, radius, params=layer_params), offset) for index, layer_params, offset in self._layers(params)]
+        lims = np.zeros(len(x) + 1, dtype=np.int64)
+        distances, labels = [np.empty(0, dtype=np.float32)], [np.empty(0, dtype=np.int64)]
+        for q in range(len(x)):
+            for (l, d, i), offset in results:
+                distances.append(d[l[q] : l[q + 1]])
+                labels.append(i[l[q] : l[q + 1]] + offset)
+                lims[q + 1] += l[q + 1] - l[q]
+            lims[q + 1] += lims[q]
+        return lims, np.concatenate(distances), np.concatenate(labels)
+
+    def reconstruct_batch(self, positions: np.ndarray) -> np.ndarray:
+        positions = np.asarray(positions, dtype=np.int64)
+        vectors = np.empty((len(positions), self.d), dtype=np.float32)
+        mapped = positions < self.base.ntotal
+        if mapped.any():
+            vectors[mapped] = self.base.reconstruct_batch(positions[mapped])
+        if not mapped.all():
+            vectors[~mapped] = self.delta.reconstruct_batch(positions[~mapped] - self.base.ntotal)
+        return vectors
+
+    def merged(self) -> faiss.Index:
+        # writable in-memory copy of both layers, adding to the mapped index itself aborts in faiss
+        index = prepare_index(faiss.read_index(self.path))
+        if self.delta.ntotal:
+            index.add(self.delta.reconstruct_n(0, self.delta.ntotal))
+        return index
@@ -2,54 +2,53 @@ import os
 from python.helpers import perplexity_search
 from python.helpers import duckduckgo_search
 from . import memory_tool
-import concurrent.futures
+import asyncio
 from python.helpers.tool import Tool, Response
 from python.helpers.print_style import PrintStyle
 from python.helpers.errors import handle_error
 
 class Knowledge(Tool):
+    idempotent = True
+    parallel_safe = True
+
     async def execute(self, question="", **kwargs):
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            # Schedule the two functions to be run in parallel
-
-            # perplexity search, if API key provided
-            if os.getenv("API_KEY_PERPLEXITY"):
-                perplexity = executor.submit(perplexity_search.perplexity_search, question)
-            else: 
-                PrintStyle.hint("No API key provided for Perplexity. Skipping Perplexity search.")
-                self.agent.context.log.log(type="hint", content="No API key provided for Perplexity. Skipping Perplexity search.")
-                perplexity = None
-                
-
-            # duckduckgo search
-            duckduckgo = executor.submit(duckduckgo_search.search, question)
-
-            # memory search
-            future_memory = executor.submit(memory_tool.search, self.agent, question)
-
-            # Wait for both functions to complete
-            try:
-                perplexity_result = (perplexity.result() if perplexity else "") or ""
-            except Exception as e:
-                handle_error(e)
-                perplexity_result = "Perplexity search failed: " + str(e)
-
-            try:
-                duckduckgo_result = duckduckgo.result()
-            except Exception as e:
-                handle_error(e)
-                duckduckgo_result = "DuckDuckGo search failed: " + str(e)
-
-            try:
-                memory_result = future_memory.result()
-            except Exception as e:
-                handle_error(e)
-                memory_result = "Memory search failed: " + str(e)
+        # searches run in worker threads so that the event loop and other tool calls are not blocked
+
+        # perplexity search, if API key provided
+        if os.getenv("API_KEY_PERPLEXITY"):
+            perplexity = asyncio.to_thread(perplexity_search.perplexity_search, question)
+        else: 
+            PrintStyle.hint("No API key provided for Perplexity. Skipping Perplexity search.")
+            self.agent.context.log.log(type="hint", content="No API key provided for Perplexity. Skipping Perplexity search.")
+            perplexity = None
+
+        # duckduckgo search
+        duckduckgo = asyncio.to_thread(duckduckgo_search.search, question)
+
+        # memory search
+        future_memory = memory_tool.search(self.agent, question)
+
+        # Wait for all searches to complete
+        perplexity_result, duckduckgo_result, memory_result = await asyncio.gather(
+            perplexity or asyncio.sleep(0, ""), duckduckgo, future_memory, return_exceptions=True)
+
+        if isinstance(perplexity_result, BaseException):
+            handle_error(perplexity_result) # type: ignore
+            perplexity_result = "Perplexity search failed: " + str(perplexity_result)
+        perplexity_result = perplexity_result or ""
+
+        if isinstance(duckduckgo_result, BaseException):
+            handle_error(duckduckgo_result) # type: ignore
+            duckduckgo_result = "DuckDuckGo search failed: " + str(duckduckgo_result)
+
+        if isinstance(memory_result, BaseException):
+            handle_error(memory_result) # type: ignore
+            memory_result = "Memory search failed: " + str(memory_result)
 
         msg = self.agent.read_prompt("tool.knowledge.response.md", 
                               online_sources = ((perplexity_result + "\n\n") if perplexity else "") + str(duckduckgo_result),
                               memory = memory_result )
 
-        if self.agent.handle_intervention(msg): pass # wait for intervention and handle it, if paused
+        await self.agent.handle_intervention() # wait for intervention and handle it, if paused
 
         return Response(message=msg, break_loop=False)
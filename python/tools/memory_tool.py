@@ -1,15 +1,30 @@
+import asyncio
 import re
-from agent import Agent
-from python.helpers.vector_db import VectorDB, Document
+import threading
+from agent import Agent, AgentConfig, RepairableException
+from python.helpers.vector_db import VectorDB, Document, SEARCH_MODES
+from python.helpers.vector_db_cache import VectorDBCache
 import os
 from python.helpers.tool import Tool, Response
 from python.helpers.print_style import PrintStyle
 from python.helpers.errors import handle_error
+from python.helpers.log import Log
+from python.helpers import document_store
 
-# databases based on subdirectories from agent config
-dbs = {}
+# databases based on subdirectories from agent config, idle and least recently used ones are unloaded
+dbs = VectorDBCache()
 
 class Memory(Tool):
+
+    # only queries are read only, memorize, forget and delete modify the database
+    @classmethod
+    def is_idempotent(cls, args: dict) -> bool:
+        return "query" in args
+
+    @classmethod
+    def is_parallel_safe(cls, args: dict) -> bool:
+        return cls.is_idempotent(args)
+
     async def execute(self,**kwargs):
         result=""
         
@@ -17,13 +32,20 @@ class Memory(Tool):
             if "query" in kwargs:
                 threshold = float(kwargs.get("threshold", 0.1))
                 count = int(kwargs.get("count", 5))
-                result = search(self.agent, kwargs["query"], count, threshold)
+                mode = kwargs.get("mode", "hybrid")
+                if mode not in SEARCH_MODES:
+                    raise RepairableException(f"Unknown memory search mode '{mode}', use one of {', '.join(SEARCH_MODES)}.")
+                filter = check_filter(kwargs.get("filter"))
+                result = await search(self.agent, kwargs["query"], count, threshold, mode, filter) # queries can run in parallel with other tools
             elif "memorize" in kwargs:
-                result = save(self.agent, kwargs["memorize"])
+                result = await save(self.agent, kwargs["memorize"], kwargs.get("area", "main"))
             elif "forget" in kwargs:
-                result = forget(self.agent, kwargs["forget"])
+                filter = check_filter(kwargs.get("filter"))
+                result = await forget(self.agent, kwargs["forget"], float(kwargs.get("threshold", 0.1)), filter)
             elif "delete" in kwargs:
-                result = delete(self.agent, kwargs["delete"])
+                result = await delete(self.agent, kwargs["delete"])
+        except RepairableException:
+            raise # invalid arguments, the agent can correct them
         except Exception as e:
             handle_error(e)
             # hint about embedding change with existing database
@@ -34,41 +56,69 @@ class Memory(Tool):
         # result = process_query(self.agent, self.args["memory"],self.args["action"], result_count=self.agent.config.auto_memory_count)
         return Response(message=result, break_loop=False)
             
-def search(agent:Agent, query:str, count:int=5, threshold:float=0.1):
-    db = get_db(agent)
+def check_filter(filter):
+    # filters are written by the agent, mistakes are reported back to it instead of ending the loop
+    try:
+        document_store.check_filter(filter)
+    except ValueError as e:
+        raise RepairableException(f"Invalid memory filter: {e}")
+    return filter
+
+# the database work runs on the VectorDB thread pool, the event loop is never blocked
+
+async def search(agent:Agent, query:str, count:int=5, threshold:float=0.1, mode:str="hybrid", filter:dict|None=None):
+    db = await aget_db(agent)
     # docs = db.search_similarity(query,count) # type: ignore
-    docs = db.search_similarity_threshold(query,count,threshold) # type: ignore
+    docs = await db.asearch(query,count,threshold,mode,filter)
     if len(docs)==0: return agent.read_prompt("fw.memories_not_found.md", query=query)
     else: return str(docs)
 
-def save(agent:Agent, text:str):
-    db = get_db(agent)
-    id = db.insert_text(text) # type: ignore
-    return agent.read_prompt("fw.memory_saved.md", memory_id=id)
+async def save(agent:Agent, text:str, area:str="main"):
+    db = await aget_db(agent)
+    ids = await db.ainsert([Document(text, metadata={"area": area})])
+    return agent.read_prompt("fw.memory_saved.md", memory_id=ids[0])
 
-def delete(agent:Agent, ids_str:str):
-    db = get_db(agent)
+async def delete(agent:Agent, ids_str:str):
+    db = await aget_db(agent)
     ids = extract_guids(ids_str)
-    deleted = db.delete_documents_by_ids(ids) # type: ignore
+    deleted = await db.adelete(ids)
     return agent.read_prompt("fw.memories_deleted.md", memory_count=deleted)    
 
-def forget(agent:Agent, query:str):
-    db = get_db(agent)
-    deleted = db.delete_documents_by_query(query) # type: ignore
+async def forget(agent:Agent, query:str, threshold:float=0.1, filter:dict|None=None):
+    db = await aget_db(agent)
+    deleted = await db.adelete_by_query(query, threshold, filter)
     return agent.read_prompt("fw.memories_deleted.md", memory_count=deleted)
 
-def get_db(agent: Agent):
-    mem_dir = os.path.join("memory", agent.config.memory_subdir)
-    kn_dir = os.path.join("knowledge", agent.config.knowledge_subdir)
+async def aget_db(agent: Agent):
+    # the cache lookup can unload other databases, which flushes them, so it runs off the event loop too
+    # opened on first use, or waits for the background warm-up to finish
+    db = await asyncio.to_thread(get_db_for, agent.config, agent.context.log)
+    return await db.aopen()
+
+def get_db_for(config: AgentConfig, logger: Log) -> VectorDB:
+    mem_dir = os.path.join("memory", config.memory_subdir)
+    kn_dir = os.path.join("knowledge", config.knowledge_subdir)
     key = (mem_dir, kn_dir)
 
-    if key not in dbs:
-        db = VectorDB(agent.context.log,embeddings_model=agent.config.embeddings_model, in_memory=False, memory_dir=mem_dir, knowledge_dir=kn_dir)
-        dbs[key] = db
-    else:
-        db = dbs[key]
+    return dbs.get(key, lambda: VectorDB(logger,embeddings_model=config.embeddings_model, in_memory=False, memory_dir=mem_dir, knowledge_dir=kn_dir,
+                          flush_seconds=config.memory_flush_seconds, flush_ops=config.memory_flush_ops,
+                          index_type=config.memory_index_type, promote_at=config.memory_index_promote_at))
+
+def warm_up(config: AgentConfig, logger: Log | None = None) -> threading.Thread:
+    # loads the memory index and imports knowledge at process start instead of during the first agent turn
+    # the cache limits are shared by all contexts, they are taken from the startup config only
+    dbs.configure(config.memory_cache_size, config.memory_cache_idle_seconds, config.memory_cache_max_mb)
+    db = get_db_for(config, logger or Log())
+
+    def run():
+        try:
+            db.open()
+        except Exception as e:
+            PrintStyle.error(f"Memory warm-up failed, it will be retried on first use: {e}")
 
-    return db
+    thread = threading.Thread(target=run, name="memory-warm-up", daemon=True)
+    thread.start()
+    return thread
         
 def extract_guids(text):
     pattern = r'\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[1-5][0-9a-fA-F]{3}-[89abAB][0-9a-fA-F]{3}-[0-9a-fA-F]{12}\b'
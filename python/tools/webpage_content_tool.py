@@ -1,3 +1,4 @@
+import asyncio
 import requests
 from bs4 import BeautifulSoup
 from urllib.parse import urlparse
@@ -7,6 +8,9 @@ from python.helpers.errors import handle_error
 
 
 class WebpageContentTool(Tool):
+    idempotent = True
+    parallel_safe = True
+
     async def execute(self, url="", **kwargs):
         if not url:
             return Response(message="Error: No URL provided.", break_loop=False)
@@ -17,21 +21,8 @@ class WebpageContentTool(Tool):
             if not all([parsed_url.scheme, parsed_url.netloc]):
                 return Response(message="Error: Invalid URL format.", break_loop=False)
 
-            # Fetch webpage content
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-
-            # Use newspaper3k for article extraction
-            article = Article(url)
-            article.download()
-            article.parse()
-
-            # If it's not an article, fall back to BeautifulSoup
-            if not article.text:
-                soup = BeautifulSoup(response.content, 'html.parser')
-                text_content = ' '.join(soup.stripped_strings)
-            else:
-                text_content = article.text
+            # Download in a worker thread, other tool calls can run meanwhile
+            text_content = await asyncio.to_thread(self.fetch_content, url)
 
             return Response(message=f"Webpage content:\n\n{text_content}", break_loop=False)
 
@@ -39,4 +30,20 @@ class WebpageContentTool(Tool):
             return Response(message=f"Error fetching webpage: {str(e)}", break_loop=False)
         except Exception as e:
             handle_error(e)
-            return Response(message=f"An error occurred: {str(e)}", break_loop=False)
\ No newline at end of file
+            return Response(message=f"An error occurred: {str(e)}", break_loop=False)
+
+    def fetch_content(self, url: str) -> str:
+        # Fetch webpage content
+        response = requests.get(url, timeout=10)
+        response.raise_for_status()
+
+        # Use newspaper3k for article extraction
+        article = Article(url)
+        article.download()
+        article.parse()
+
+        # If it's not an article, fall back to BeautifulSoup
+        if not article.text:
+            soup = BeautifulSoup(response.content, 'html.parser')
+            return ' '.join(soup.stripped_strings)
+        return article.text
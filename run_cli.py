@@ -6,9 +6,10 @@ from ansio.input import InputEvent, get_input_event
 from agent import AgentContext
 from python.helpers.print_style import PrintStyle
 from python.helpers.files import read_file
-from python.helpers import files
+from python.helpers import files, tokens
 import python.helpers.timed_input as timed_input
 from initialize import initialize
+from python.tools import memory_tool
 
 
 context: AgentContext = None # type: ignore
@@ -100,6 +101,10 @@ if __name__ == "__main__":
     config = initialize()
     context = AgentContext(config)
 
+    # load memory and knowledge in the background while the user types
+    memory_tool.warm_up(config, context.log)
+    tokens.load_tokenizer()
+
     # Start the key capture thread for user intervention during agent streaming
     threading.Thread(target=capture_keys, daemon=True).start()
 
@@ -11,6 +11,8 @@ from initialize import initialize
 from python.helpers.files import get_abs_path
 from python.helpers.print_style import PrintStyle
 from python.helpers.log import Log
+from python.helpers import tokens
+from python.tools import memory_tool
 from dotenv import load_dotenv
 
 
@@ -247,6 +249,11 @@ async def poll():
 if __name__ == "__main__":
 
     load_dotenv()
+
+    # create the first context and load its memory and knowledge in the background while the server starts
+    context = get_context("")
+    memory_tool.warm_up(context.config, context.log)
+    tokens.load_tokenizer()
     
     # Suppress only request logs but keep the startup messages
     from werkzeug.serving import WSGIRequestHandler
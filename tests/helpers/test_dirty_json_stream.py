@@ -0,0 +1,61 @@
+import unittest
+from python.helpers.dirty_json import DirtyJsonStream
+
+
+def feed_in_chunks(text: str, size: int) -> DirtyJsonStream:
+    parser = DirtyJsonStream()
+    for i in range(0, len(text), size):
+        parser.feed(text[i : i + size])
+    return parser
+
+
+class TestDirtyJsonStream(unittest.TestCase):
+    def assertParsed(self, text: str, expected):
+        for size in (1, 2, 3, 7, len(text)):
+            self.assertEqual(feed_in_chunks(text, size).result, expected, f"chunk size {size}")
+
+    def test_agent_response(self):
+        text = ('Sure. {"thoughts": ["Save the file.", "Use \\"terminal\\"."], "tool_name": "code_execution_tool", '
+                '"tool_args": {"runtime": "terminal", "code": "echo \'print(1)\' > a.py\\nls"}} trailing')
+        self.assertParsed(text, {
+            "thoughts": ["Save the file.", 'Use "terminal".'],
+            "tool_name": "code_execution_tool",
+            "tool_args": {"runtime": "terminal", "code": "echo 'print(1)' > a.py\nls"},
+        })
+
+    def test_dirty_values(self):
+        text = "{'a': 1, b: -2.5e3, c: true, d: NULL, e: [1, {\"x\": []}], f: hello world, g: \"\\u00e9\"}"
+        self.assertParsed(text, {"a": 1, "b": -2500.0, "c": True, "d": None, "e": [1, {"x": []}], "f": "hello world", "g": "é"})
+
+    def test_multiline_string(self):
+        self.assertParsed('{"code": """\nprint("hi")\n""", "e": \'\'}', {"code": 'print("hi")', "e": ""})
+
+    def test_double_braces(self):
+        self.assertParsed('{{"a": {"b": 1}}}', {"a": {"b": 1}})
+
+    def test_partial_values(self):
+        parser = DirtyJsonStream()
+        parser.feed('{"tool_name": "resp')
+        self.assertEqual(parser.result, {"tool_name": "resp"})
+        parser.feed('onse", "tool_args": {"text": "Hel')
+        self.assertEqual(parser.result, {"tool_name": "response", "tool_args": {"text": "Hel"}})
+        self.assertFalse(parser.done)
+
+    def test_long_partial_string(self):
+        parser = feed_in_chunks('{"text": "' + "ab\\n" * 5000, 3)
+        text = parser.result["text"]  # type: ignore
+        self.assertTrue(text.startswith("ab\nab\n"))
+        self.assertGreaterEqual(len(text), 0.8 * 15000)  # republished after growing by a quarter at most
+        parser.feed('"}')
+        self.assertEqual(parser.result, {"text": "ab\n" * 5000})
+
+    def test_end_of_root_object(self):
+        text = 'Text {"a": "}"} and more {"b": 1}'
+        parser = feed_in_chunks(text, 4)
+        self.assertTrue(parser.done)
+        self.assertEqual(text[: parser.end], 'Text {"a": "}"}')
+        self.assertEqual(parser.result, {"a": "}"})
+
+
+if __name__ == "__main__":
+    unittest.main()
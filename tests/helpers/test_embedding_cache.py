@@ -0,0 +1,39 @@
+import os
+import tempfile
+import unittest
+from langchain.storage import LocalFileStore
+from python.helpers.embedding_cache import SQLiteByteStore, migrate_local_file_store
+
+
+class TestEmbeddingCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = SQLiteByteStore(os.path.join(self.tmp.name, "embeddings.db"))
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+    def test_get_set_delete(self):
+        pairs = [(f"ns{i % 2}key{i}", str(i).encode()) for i in range(1200)]
+        self.store.mset(pairs)
+        self.assertEqual(self.store.mget(["ns0key0", "missing", "ns1key1199"]), [b"0", None, b"1199"])
+        self.assertEqual(len(self.store.mget([key for key, _ in pairs])), 1200)
+        self.assertEqual(len(list(self.store.yield_keys(prefix="ns1"))), 600)
+
+        self.store.mdelete(["ns0key0", "ns1key1"])
+        self.assertEqual(self.store.mget(["ns0key0", "ns1key1", "ns0key2"]), [None, None, b"2"])
+
+    def test_migrate_local_file_store(self):
+        directory = os.path.join(self.tmp.name, "embeddings")
+        old = LocalFileStore(directory)
+        old.mset([("model/with/slashes" + str(i), b"vector%d" % i) for i in range(5)])
+
+        self.assertEqual(migrate_local_file_store(self.store, directory, batch_size=2), 5)
+        self.assertFalse(os.path.exists(directory))
+        self.assertEqual(self.store.mget(["model/with/slashes3"]), [b"vector3"])
+        self.assertEqual(migrate_local_file_store(self.store, directory), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
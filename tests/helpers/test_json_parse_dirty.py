@@ -55,6 +55,22 @@ class TestJsonParseDirty(unittest.TestCase):
         }
         self.assertEqual(json_parse_dirty(json_string), expected_result)
 
+    def test_tool_calls(self):
+        json_string = ('{"thoughts": ["Two lookups."], "tool_calls": ['
+                       '{"tool_name": "knowledge_tool", "tool_args": {"question": "a"}}, '
+                       '{"tool_name": "memory_tool", "tool_args": {"query": "b"}}]}')
+        expected_result = {
+            "thoughts": ["Two lookups."],
+            "tool_calls": [
+                {"tool_name": "knowledge_tool", "tool_args": {"question": "a"}},
+                {"tool_name": "memory_tool", "tool_args": {"query": "b"}},
+            ]
+        }
+        self.assertEqual(json_parse_dirty(json_string), expected_result)
+
+    def test_double_braces(self):
+        self.assertEqual(json_parse_dirty('{{"key": {"inner": "value"}}}'), {"key": {"inner": "value"}})
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
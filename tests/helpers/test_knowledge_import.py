@@ -0,0 +1,108 @@
+import os
+import tempfile
+import time
+import unittest
+from langchain_core.documents import Document
+from python.helpers import knowledge_import
+from python.helpers.knowledge_import import load_files, iter_knowledge, match_chunks
+from python.helpers.log import Log
+
+
+def fake_loader(path: str) -> list[Document]:
+    # runs in a worker process
+    name = os.path.basename(path)
+    if name.startswith("slow"):
+        time.sleep(60)
+    if name.startswith("crash"):
+        os._exit(1)
+    if name.startswith("bad"):
+        raise ValueError("corrupt file")
+    return [Document(name)]
+
+
+class TestLoadFiles(unittest.TestCase):
+    def test_failures_are_isolated(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, name) for name in ["a", "slow", "b", "bad", "c", "crash", "d"]]
+            started = time.time()
+            results = dict(load_files(paths, workers=2, timeout=5, loader=fake_loader))
+
+        self.assertLess(time.time() - started, 30)
+        self.assertEqual(set(results), set(paths))
+        for name in ["a", "b", "c", "d"]:
+            self.assertEqual(results[os.path.join(tmp, name)][0].page_content, name)  # type: ignore
+        self.assertIsInstance(results[os.path.join(tmp, "slow")], TimeoutError)
+        self.assertIsInstance(results[os.path.join(tmp, "bad")], ValueError)
+        self.assertIsInstance(results[os.path.join(tmp, "crash")], Exception)
+
+
+class TestChangeDetection(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "a.txt")
+        with open(self.path, "w") as f:
+            f.write("knowledge")
+        self.hashed = []
+        self.calculate_checksums = knowledge_import.calculate_checksums
+        knowledge_import.calculate_checksums = self.counting_checksums
+
+    def tearDown(self):
+        knowledge_import.calculate_checksums = self.calculate_checksums
+        self.tmp.cleanup()
+
+    def counting_checksums(self, file_path, hash_types):
+        self.hashed.append(sorted(hash_types))
+        return self.calculate_checksums(file_path, hash_types)
+
+    def scan(self, index):
+        self.hashed.clear()
+        return [key for key, _ in iter_knowledge(Log(), self.tmp.name, index)]
+
+    def test_legacy_md5_entry_is_upgraded_without_reload(self):
+        md5 = knowledge_import.calculate_checksum(self.path, "md5")
+        index = {"a.txt": {"file": "a.txt", "checksum": md5, "ids": ["x"]}}
+
+        self.assertEqual(self.scan(index), [])
+        self.assertEqual(self.hashed, [sorted([knowledge_import.HASH_TYPE, "md5"])])
+        entry = index["a.txt"]
+        self.assertEqual(entry["state"], "original")
+        self.assertEqual(entry["checksum_type"], knowledge_import.HASH_TYPE)
+        self.assertEqual(entry["size"], 9)
+
+        # unchanged size, mtime and inode, the file is not read
+        self.assertEqual(self.scan(index), [])
+        self.assertEqual(self.hashed, [])
+
+        # touched but same content, hashed again but not reloaded
+        os.utime(self.path, ns=(entry["mtime"] + 10**9, entry["mtime"] + 10**9))
+        self.assertEqual(self.scan(index), [])
+        self.assertEqual(self.hashed, [[knowledge_import.HASH_TYPE]])
+
+
+class TestMatchChunks(unittest.TestCase):
+    def test_unchanged_chunks_keep_ids(self):
+        old = [Document("a"), Document("b"), Document("b"), Document("c", metadata={"page": 1})]
+        file_data = {"documents": old}
+        new_docs, stale = match_chunks(file_data)  # type: ignore
+        self.assertEqual((len(new_docs), stale), (4, []))
+        for i, doc in enumerate(old):
+            doc.metadata["id"] = f"id{i}"
+        file_data["ids"] = [doc.metadata["id"] for doc in old]
+
+        file_data["documents"] = [Document("b"), Document("a"), Document("new"), Document("c", metadata={"page": 2})]
+        new_docs, stale = match_chunks(file_data, exists=lambda id: id != "id0")  # type: ignore
+
+        self.assertEqual([doc.page_content for doc in new_docs], ["a", "new", "c"])
+        self.assertEqual(file_data["documents"][0].metadata["id"], "id2")
+        self.assertEqual(sorted(stale), ["id0", "id1", "id3"])
+        self.assertEqual(len(file_data["chunks"]), 4)
+
+
+class TestFileType(unittest.TestCase):
+    def test_extension_only(self):
+        for path, file_type in [("/kn/Manual.PDF", "pdf"), ("notes/a.b.md", "md"), ("/kn/v1.2/README", ""), ("/kn/.env", "")]:
+            self.assertEqual(knowledge_import.get_file_type(path), file_type, path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import asyncio
+import time
+import unittest
+from python.helpers import rate_limiter
+from python.helpers.rate_limiter import RateLimiter
+
+
+class FakeModel:
+    def __init__(self, model_name: str, base_url: str):
+        self.model_name = model_name
+        self.base_url = base_url
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_wait_does_not_block_event_loop(self):
+        limiter = RateLimiter(max_calls=1, max_input_tokens=0, max_output_tokens=0, window_seconds=0.3)  # type: ignore
+        ticks = []
+
+        async def ticker():
+            for _ in range(5):
+                ticks.append(time.time())
+                await asyncio.sleep(0.02)
+
+        async def run():
+            await limiter.acquire(1)
+            start = time.time()
+            await asyncio.gather(limiter.acquire(1), ticker())
+            return time.time() - start
+
+        elapsed = asyncio.run(run())
+        self.assertGreaterEqual(elapsed, 0.25)
+        self.assertEqual(len(ticks), 5)
+        self.assertLess(ticks[-1] - ticks[0], 0.25)  # ticker ran while the limiter was waiting
+
+    def test_fair_between_owners(self):
+        limiter = RateLimiter(max_calls=1, max_input_tokens=0, max_output_tokens=0, window_seconds=0.05)  # type: ignore
+        order = []
+
+        async def call(owner: str, no: int):
+            await limiter.acquire(1, owner=owner)
+            order.append(f"{owner}{no}")
+
+        async def run():
+            await limiter.acquire(1)  # empty the bucket so everyone has to queue
+            tasks = [asyncio.create_task(call("a", i)) for i in range(3)]
+            tasks += [asyncio.create_task(call("b", i)) for i in range(2)]
+            await asyncio.gather(*tasks)
+
+        asyncio.run(run())
+        self.assertEqual(order, ["a0", "b0", "a1", "b1", "a2"])
+
+    def test_cancelled_waiter_releases_queue(self):
+        limiter = RateLimiter(max_calls=1, max_input_tokens=0, max_output_tokens=0, window_seconds=0.1)  # type: ignore
+
+        async def run():
+            await limiter.acquire(1)
+            first = asyncio.create_task(limiter.acquire(1))
+            second = asyncio.create_task(limiter.acquire(1))
+            await asyncio.sleep(0.01)
+            first.cancel()
+            await asyncio.wait_for(second, 1)
+            return limiter.utilization()
+
+        utilization = asyncio.run(run())
+        self.assertEqual(utilization["waiting"], 0)
+        self.assertGreater(utilization["calls"], 0.5)
+
+    def test_output_tokens_are_booked_after_call(self):
+        limiter = RateLimiter(max_calls=0, max_input_tokens=0, max_output_tokens=100, window_seconds=60)
+
+        async def run():
+            record = await limiter.acquire(10)
+            limiter.set_output_tokens(150, record)
+            return record
+
+        record = asyncio.run(run())
+        self.assertEqual(record.output_tokens, 150)
+        self.assertEqual(limiter.utilization()["output_tokens"], 1.0)
+        wait, reasons = limiter._get_wait(1)
+        self.assertGreater(wait, 0)
+        self.assertEqual(reasons, ["max output tokens"])
+
+    def test_shared_by_endpoint(self):
+        a = rate_limiter.get_limiter(FakeModel("m", "http://a"), 10, 0, 0, 60)
+        b = rate_limiter.get_limiter(FakeModel("m", "http://a"), 5, 0, 0, 60)
+        c = rate_limiter.get_limiter(FakeModel("m", "http://c"), 10, 0, 0, 60)
+        self.assertIs(a, b)
+        self.assertIsNot(a, c)
+        self.assertEqual(a.calls.capacity, 10)  # the first configuration wins
+        self.assertIn(a.name, rate_limiter.get_utilization())
+
+
+if __name__ == "__main__":
+    unittest.main()
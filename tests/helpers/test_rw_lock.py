@@ -0,0 +1,64 @@
+import threading
+import time
+import unittest
+from python.helpers.rw_lock import ReadWriteLock
+
+
+class TestReadWriteLock(unittest.TestCase):
+    def test_readers_share_writers_exclude(self):
+        lock = ReadWriteLock()
+        inside = []
+        both_reading = threading.Barrier(2, timeout=5)
+
+        def read():
+            with lock.read():
+                inside.append("read")
+                both_reading.wait()  # fails unless two readers hold the lock at once
+
+        readers = [threading.Thread(target=read) for _ in range(2)]
+        for thread in readers: thread.start()
+        for thread in readers: thread.join()
+        self.assertEqual(inside, ["read", "read"])
+
+        def read_once():
+            with lock.read():
+                inside.append("after write")
+
+        with lock:
+            reader = threading.Thread(target=read_once)
+            reader.start()
+            reader.join(0.1)
+            self.assertTrue(reader.is_alive())
+            with lock, lock.read():  # reentrant for the writing thread
+                pass
+        reader.join(5)
+        self.assertEqual(inside[-1], "after write")
+
+    def test_waiting_writer_goes_before_new_readers(self):
+        lock = ReadWriteLock()
+        order = []
+
+        def write():
+            with lock:
+                order.append("write")
+
+        def read():
+            with lock.read():
+                order.append("read")
+
+        with lock.read():
+            writer = threading.Thread(target=write)
+            writer.start()
+            while not lock.waiting_writers:
+                time.sleep(0.01)
+            reader = threading.Thread(target=read)
+            reader.start()
+            reader.join(0.1)
+            self.assertEqual(order, [])
+        writer.join(5)
+        reader.join(5)
+        self.assertEqual(order, ["write", "read"])
+
+
+if __name__ == "__main__":
+    unittest.main()
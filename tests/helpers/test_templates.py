@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+from python.helpers import templates
+from python.helpers.templates import Template, TemplateRegistry
+
+
+class TestTemplates(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.default = os.path.join(self.tmp.name, "default")
+        self.custom = os.path.join(self.tmp.name, "custom")
+        os.makedirs(self.default)
+        os.makedirs(self.custom)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, dir, name, text, mtime=None):
+        path = os.path.join(dir, name)
+        with open(path, "w") as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def test_render(self):
+        template = Template("Hello {{name}}, {{unknown}} {{name}}!")
+        self.assertEqual(template.render(name="A0"), "Hello A0, {{unknown}} A0!")
+
+    def test_code_fences_removed(self):
+        self.write(self.default, "a.md", "~~~json\n{\"a\": \"{{x}}\"}\n~~~")
+        registry = TemplateRegistry(self.default)
+        self.assertEqual(registry.render("a.md", x=1), '{"a": "1"}\n')
+
+    def test_subdir_overrides_default(self):
+        self.write(self.default, "a.md", "default")
+        self.write(self.default, "b.md", "default b")
+        self.write(self.custom, "a.md", "custom")
+        self.write(self.custom, "b.md", "")
+        registry = TemplateRegistry(self.custom, self.default)
+        self.assertEqual(registry.render("a.md"), "custom")
+        self.assertEqual(registry.render("b.md"), "default b")
+
+    def test_missing_file(self):
+        registry = TemplateRegistry(self.default)
+        with self.assertRaises(FileNotFoundError):
+            registry.render("missing.md")
+
+    def test_reload_on_mtime_change(self):
+        self.write(self.default, "a.md", "old", mtime=1000)
+        registry = TemplateRegistry(self.default)
+        self.assertEqual(registry.render("a.md"), "old")
+
+        self.write(self.default, "a.md", "new", mtime=2000)
+        self.assertEqual(registry.render("a.md"), "old")  # within check interval
+
+        interval = templates.CHECK_INTERVAL
+        templates.CHECK_INTERVAL = 0
+        try:
+            self.assertEqual(registry.render("a.md"), "new")
+        finally:
+            templates.CHECK_INTERVAL = interval
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,347 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+from python.helpers.log import Log
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+import numpy as np
+from python.helpers.vector_db import ID_MAPPING_BYTES, VectorDB, batch_documents, max_marginal_relevance
+
+
+class TestVectorDB(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.memory_dir = os.path.join(self.tmp.name, "memory")
+        self.dbs: list[VectorDB] = []
+
+    def tearDown(self):
+        for db in self.dbs:
+            self.wait_rebuild(db)
+            db.flush()
+        self.tmp.cleanup()
+
+    def open(self, **kwargs) -> VectorDB:
+        db = VectorDB(Log(), DeterministicFakeEmbedding(size=16), in_memory=True, memory_dir=self.memory_dir, knowledge_dir="", **kwargs)
+        self.dbs.append(db)
+        return db.open()
+
+    def test_writes_are_logged_until_flush(self):
+        db = self.open()
+        a = db.insert_text("alpha")
+        db.insert_text("beta")
+        db.delete_documents_by_ids([a])
+        self.assertFalse(os.path.exists(os.path.join(db.db_dir, "index.faiss")))
+        self.assertEqual(db.pending_ops, 3)
+
+        db.flush()
+        self.assertTrue(os.path.exists(os.path.join(db.db_dir, "index.faiss")))
+        self.assertFalse(os.path.exists(db.oplog_path))
+        self.assertEqual(len(self.open().index_to_docstore_id), 1)
+
+    def test_replay_after_crash(self):
+        db = self.open()
+        db.insert_text("persisted")
+        db.flush()
+        b = db.insert_text("beta")
+        db.insert_text("gamma")
+        db.delete_documents_by_ids([b])
+        with open(db.oplog_path, "a") as f:
+            f.write('{"op": "add", "ids": ["torn')  # crashed in the middle of a write
+        db.flush_timer.cancel()  # type: ignore
+
+        recovered = self.open()
+        texts = sorted(doc.page_content for doc in recovered.docstore.mget(list(recovered.docstore.ids())))  # type: ignore
+        self.assertEqual(texts, ["gamma", "persisted"])
+        self.assertFalse(os.path.exists(recovered.oplog_path))
+
+    def test_flush_on_op_count(self):
+        db = self.open(flush_ops=2)
+        db.insert_text("alpha")
+        self.assertTrue(os.path.exists(db.oplog_path))
+        db.insert_text("beta")
+        self.assertFalse(os.path.exists(db.oplog_path))
+        self.assertEqual(db.pending_ops, 0)
+
+    def wait_rebuild(self, db: VectorDB):
+        thread = db.rebuild_thread
+        if thread:
+            thread.join(30)
+
+    def test_promotion_to_hnsw(self):
+        db = self.open(index_type="hnsw", promote_at=50)
+        ids = db.insert_documents([Document(f"doc {i}") for i in range(60)])
+        self.wait_rebuild(db)
+        stats = db.stats()
+        self.assertEqual(stats["index_type"], "hnsw")
+        self.assertGreater(stats["build_recall"], 0.9)
+        self.assertEqual(db.search_similarity("doc 7", 1)[0].page_content, "doc 7")
+
+        db.delete_documents_by_ids(ids[:5])
+        self.assertEqual(db.stats()["tombstones"], 5)
+        self.assertNotEqual(db.search_similarity("doc 3", 1)[0].page_content, "doc 3")
+        self.assertEqual(len(db.search_similarity("doc 3", 100)), 55)
+
+        db.flush()
+        reopened = self.open(index_type="hnsw", promote_at=50)
+        self.assertEqual(reopened.stats()["index_type"], "hnsw")
+        self.assertEqual(reopened.stats()["tombstones"], 5)
+
+    def test_promotion_to_ivf(self):
+        db = self.open(index_type="ivf_flat", promote_at=1000)
+        db.insert_documents([Document(f"doc {i}") for i in range(1100)])
+        self.wait_rebuild(db)
+        self.assertEqual(db.stats()["index_type"], "ivf_flat")
+        self.assertEqual(db.search_similarity("doc 42", 1)[0].page_content, "doc 42")
+        self.assertEqual(len(db.search_max_rel("doc 42", 3)), 3)
+        db.flush()
+        self.assertTrue(db.stats()["mapped"])
+        self.assertGreaterEqual(db.memory_usage(), 1100 * 16 * 4)  # ivf lists are not mapped
+
+    def test_flat_delete_remaps_positions(self):
+        db = self.open(index_type="flat")
+        ids = db.insert_documents([Document(f"doc {i}") for i in range(10)])
+        db.delete_documents_by_ids(ids[2:4])
+        self.assertEqual(db.stats()["vectors"], 8)
+        self.assertEqual(db.stats()["tombstones"], 0)
+        for i in [0, 5, 9]:
+            self.assertEqual(db.search_similarity(f"doc {i}", 1)[0].page_content, f"doc {i}")
+
+    def test_mapped_index_after_flush(self):
+        db = self.open(index_type="flat")
+        ids = db.insert_documents([Document(f"doc {i}") for i in range(10)])
+        db.flush()
+        self.assertTrue(db.stats()["mapped"])
+        self.assertEqual(db.memory_usage(), 10 * ID_MAPPING_BYTES)  # mapped vectors are not counted
+
+        db.insert_text("added later")
+        db.delete_documents_by_ids(ids[:2])
+        self.assertEqual(db.stats()["tombstones"], 2)
+        self.assertEqual(db.search_similarity("added later", 1)[0].page_content, "added later")
+        self.assertEqual(len(db.search_similarity("doc 1", 100)), 9)
+        for query, found in [("doc 1", 0), ("doc 5", 1), ("added later", 1)]:
+            self.assertEqual(len(db.search_similarity_threshold(query, 10, threshold=0.99)), found)
+
+        db.flush()
+        self.assertEqual(db.stats()["vectors"], 9)
+        self.assertEqual(db.stats()["tombstones"], 0)
+        reopened = self.open(index_type="flat")
+        self.assertEqual(reopened.search_similarity("doc 5", 1)[0].metadata["id"], ids[5])
+        self.assertEqual(reopened.search_similarity("added later", 1)[0].page_content, "added later")
+
+    def test_legacy_pickle_migration(self):
+        db_dir = os.path.join(self.memory_dir, "database")
+        FAISS.from_texts(["alpha", "beta"], DeterministicFakeEmbedding(size=16), metadatas=[{}, {"source": "/kn/b.PDF"}], ids=["a", "b"]).save_local(db_dir)
+
+        db = self.open()
+        self.assertFalse(os.path.exists(os.path.join(db_dir, "index.pkl")))
+        self.assertEqual(db.search_similarity("beta", 1)[0].page_content, "beta")
+        self.assertEqual(db.search_similarity("beta", 2, filter={"area": "main"})[0].page_content, "alpha")
+        self.assertEqual(db.search_similarity("alpha", 2, filter={"area": "knowledge", "type": "pdf"})[0].page_content, "beta")
+        self.assertEqual(sorted(self.open().positions), ["a", "b"])
+
+    def test_keyword_search_skips_embedding(self):
+        embeddings = CountingEmbedding(size=16)
+        db = VectorDB(Log(), embeddings, in_memory=True, memory_dir=self.memory_dir, knowledge_dir="")
+        self.dbs.append(db)
+        ids = db.insert_documents([Document(f"note {i} about the weather") for i in range(20)] + [Document("connect failed with ERR_CONN_REFUSED in vector_db.py")])
+
+        embeddings.queries = 0
+        found = db.search_hybrid("ERR_CONN_REFUSED", 3, mode="keyword")
+        self.assertEqual([doc.metadata["id"] for doc in found], [ids[-1]])
+        self.assertEqual(db.search_hybrid("vector_db.py", 3, mode="keyword")[0].metadata["id"], ids[-1])
+        self.assertEqual(embeddings.queries, 0)
+
+        db.delete_documents_by_ids([ids[-1]])
+        self.assertEqual(db.search_hybrid("ERR_CONN_REFUSED", 3, mode="keyword"), [])
+
+    def test_hybrid_search_fuses_rankings(self):
+        db = self.open()
+        ids = db.insert_documents([Document(f"note {i} about the weather") for i in range(20)] + [Document("error E1234 while saving")])
+        found = db.search_hybrid("E1234", 3, threshold=-100)  # every vector passes, only one document has the code
+        self.assertEqual(len(found), 3)
+        self.assertIn(ids[-1], [doc.metadata["id"] for doc in found])
+        self.assertEqual(len(db.search_hybrid("note 7 about the weather", 5, mode="vector", threshold=0.99)), 1)
+        # keyword hits are held to the same threshold, stopwords match nothing
+        self.assertEqual(db.search_hybrid("the weather today", 5, threshold=0.99), [])
+        self.assertEqual(db.search_hybrid("about the", 5, mode="keyword"), [])
+
+    def test_metadata_filters(self):
+        db = self.open(index_type="hnsw", promote_at=50)
+        docs = [Document(f"doc {i}", metadata={"area": "knowledge", "source": f"/kn/{'manual' if i < 5 else 'notes'}.md", "type": "md"}) for i in range(60)]
+        ids = db.insert_documents(docs)
+        self.wait_rebuild(db)
+        db.flush()
+        late = db.insert_documents([Document("doc 3", metadata={"area": "main", "timestamp": "2100-01-01"})])
+
+        manual = {"area": "knowledge", "source": "manual.md"}
+        found = db.search_similarity("doc 3", 10, filter=manual)
+        self.assertEqual(sorted(doc.metadata["id"] for doc in found), sorted(ids[:5]))
+        self.assertEqual(db.search_similarity("doc 3", 1, filter={"area": "main"})[0].metadata["id"], late[0])
+        self.assertEqual(len(db.search_similarity_threshold("doc 3", 10, threshold=0.99, filter={"source": "*.md"})), 1)
+        self.assertEqual([doc.metadata["id"] for doc in db.search_hybrid("doc", 3, threshold=-100, filter={"after": "2099-01-01"})], late)
+        self.assertEqual(len(db.search_hybrid("doc", 100, mode="keyword", filter={"before": "2099-01-01", "type": ["md", "pdf"]})), 60)
+        self.assertEqual(len(db.search_max_rel("doc 3", 3, filter=manual)), 3)
+        self.assertEqual(db.search_similarity("doc 3", 3, filter={"source": "missing.md"}), [])
+        for invalid in [{"color": "red"}, {"after": "last week"}, "area=main"]:
+            with self.assertRaises(ValueError):
+                db.search_similarity("doc 3", 3, filter=invalid)
+
+        self.assertEqual(db.delete_documents_by_query("doc 3", threshold=0.99, filter={"area": "main"}), 1)
+        self.assertEqual(db.search_similarity("doc 3", 1)[0].metadata["id"], ids[3])
+
+    def test_threshold_search_and_forget(self):
+        db = self.open(index_type="hnsw", promote_at=50)
+        db.insert_documents([Document(f"doc {i}") for i in range(60)])
+        self.wait_rebuild(db)
+        db.insert_documents([Document("forget me") for _ in range(3)])
+
+        found = db.search_similarity_threshold("forget me", results=2, threshold=0.99)
+        self.assertEqual([doc.page_content for doc in found], ["forget me"] * 2)
+        self.assertEqual(len(db.search_similarity_threshold("forget me", results=10, threshold=0.99)), 3)
+
+        ops = db.pending_ops
+        self.assertEqual(db.delete_documents_by_query("forget me", threshold=0.99), 3)
+        self.assertEqual(db.pending_ops, ops + 1)  # one persisted delete
+        self.assertEqual(db.search_similarity_threshold("forget me", results=10, threshold=0.99), [])
+        self.assertEqual(db.stats()["documents"], 60)
+
+    def test_bulk_insert_persists_once(self):
+        embeddings = CountingEmbedding(size=16)
+        db = VectorDB(Log(), embeddings, in_memory=True, memory_dir=self.memory_dir, knowledge_dir="")
+        self.dbs.append(db)
+        docs = [Document(f"doc {i}") for i in range(100)]
+        ids = db.insert_documents_bulk(iter(docs), batch_size=16, concurrency=3)
+
+        self.assertEqual(ids, [doc.metadata["id"] for doc in docs])
+        self.assertEqual(embeddings.calls, 7)
+        self.assertEqual(db.stats()["documents"], 100)
+        self.assertFalse(os.path.exists(db.oplog_path))
+        self.assertEqual(len(self.open().positions), 100)
+        self.assertEqual(db.search_similarity("doc 33", 1)[0].metadata["id"], ids[33])
+
+    def test_batches_split_by_size(self):
+        docs = [Document("x" * 40) for _ in range(5)]
+        self.assertEqual([len(b) for b in batch_documents(docs, batch_size=3, batch_chars=100)], [2, 2, 1])
+        self.assertEqual([len(b) for b in batch_documents(docs, batch_size=3, batch_chars=1000)], [3, 2])
+
+    def test_lazy_open_without_dimension_probe(self):
+        embeddings = CountingEmbedding(size=16)
+        db = VectorDB(Log(), embeddings, in_memory=True, memory_dir=self.memory_dir, knowledge_dir="")
+        self.dbs.append(db)
+        self.assertFalse(db.ready.is_set())
+        self.assertEqual(db.search_similarity("anything"), [])
+        self.assertTrue(db.ready.is_set())
+        self.assertEqual(db.stats()["index_type"], None)
+
+        db.insert_text("first")
+        self.assertEqual(db.stats()["vectors"], 1)
+        db.delete_documents_by_ids(list(db.positions))
+        db.flush()
+
+        # empty index on disk, dimension comes from the cache file
+        embeddings.queries = 0
+        reopened = VectorDB(Log(), embeddings, in_memory=True, memory_dir=self.memory_dir, knowledge_dir="").open()
+        self.assertEqual(reopened.index.d, 16)  # type: ignore
+        self.assertEqual(embeddings.queries, 0)
+
+    def test_open_waits_for_warm_up(self):
+        db = VectorDB(Log(), DeterministicFakeEmbedding(size=16), in_memory=True, memory_dir=self.memory_dir, knowledge_dir="")
+        self.dbs.append(db)
+        with db.open_lock:  # warm-up in progress
+            thread = threading.Thread(target=db.insert_text, args=("waiting",))
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+        thread.join(5)
+        self.assertEqual(db.stats()["documents"], 1)
+
+    def test_max_rel_with_query_vector(self):
+        embeddings = CountingEmbedding(size=16)
+        db = VectorDB(Log(), embeddings, in_memory=True, memory_dir=self.memory_dir, knowledge_dir="")
+        self.dbs.append(db)
+        db.insert_documents([Document(f"doc {i}") for i in range(30)])
+        vector = embeddings.embed_query("doc 4")
+        embeddings.queries = 0
+        found = db.search_max_rel("doc 4", 5, vector=vector)
+        self.assertEqual(len(found), 5)
+        self.assertEqual(found[0].page_content, "doc 4")
+        self.assertEqual(embeddings.queries, 0)
+
+
+class TestAsyncVectorDB(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.embeddings = AsyncCountingEmbedding(size=16)
+        self.db = VectorDB(Log(), self.embeddings, in_memory=True, memory_dir=os.path.join(self.tmp.name, "memory"), knowledge_dir="")
+
+    async def asyncTearDown(self):
+        self.db.flush()
+        self.tmp.cleanup()
+
+    async def test_insert_search_delete(self):
+        ids = await self.db.ainsert([Document(f"doc {i}") for i in range(10)])
+        self.assertEqual(self.embeddings.async_calls, 1)
+        results = await asyncio.gather(*(self.db.asearch(f"doc {i}", 1, threshold=0.99) for i in range(10)))
+        self.assertEqual([found[0].metadata["id"] for found in results], ids)
+
+        self.assertEqual(await self.db.adelete(ids[:2]), 2)
+        self.assertEqual(await self.db.adelete_by_query("doc 5", threshold=0.99), 1)
+        self.assertEqual(self.db.stats()["documents"], 7)
+        self.assertEqual(self.embeddings.async_calls, 12)
+
+    async def test_writes_wait_for_reads(self):
+        await self.db.ainsert([Document("first")])
+        with self.db.lock.read():
+            insert = asyncio.ensure_future(self.db.ainsert([Document("second")]))
+            await asyncio.sleep(0.1)
+            self.assertFalse(insert.done())
+        await insert
+        self.assertEqual(self.db.stats()["documents"], 2)
+
+
+class TestMaxMarginalRelevance(unittest.TestCase):
+    def test_same_selection_as_langchain(self):
+        rng = np.random.default_rng(0)
+        for lambda_mult in [0.0, 0.3, 0.5, 1.0]:
+            vectors = rng.normal(size=(40, 8)).astype(np.float32)
+            query = rng.normal(size=8).astype(np.float32)
+            expected = maximal_marginal_relevance(query, vectors, lambda_mult=lambda_mult, k=10)
+            self.assertEqual(max_marginal_relevance(query, vectors, k=10, lambda_mult=lambda_mult), expected)
+
+    def test_fewer_vectors_than_k(self):
+        vectors = np.eye(3, dtype=np.float32)
+        self.assertEqual(sorted(max_marginal_relevance(vectors[1], vectors, k=5)), [0, 1, 2])
+        self.assertEqual(max_marginal_relevance(vectors[1], vectors[:0], k=5), [])
+
+
+class CountingEmbedding(DeterministicFakeEmbedding):
+    calls: int = 0
+    queries: int = 0
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        return super().embed_documents(texts)
+
+    def embed_query(self, text):
+        self.queries += 1
+        return super().embed_query(text)
+
+
+class AsyncCountingEmbedding(DeterministicFakeEmbedding):
+    async_calls: int = 0
+
+    async def aembed_documents(self, texts):
+        self.async_calls += 1
+        return self.embed_documents(texts)
+
+    async def aembed_query(self, text):
+        self.async_calls += 1
+        return self.embed_query(text)
+
+
+if __name__ == "__main__":
+    unittest.main()
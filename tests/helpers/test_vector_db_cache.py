@@ -0,0 +1,61 @@
+import os
+import tempfile
+import time
+import unittest
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from python.helpers.log import Log
+from python.helpers.vector_db import VectorDB
+from python.helpers.vector_db_cache import VectorDBCache
+
+
+class TestVectorDBCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def get(self, cache: VectorDBCache, name: str) -> VectorDB:
+        memory_dir = os.path.join(self.tmp.name, name)
+        return cache.get(name, lambda: VectorDB(Log(), DeterministicFakeEmbedding(size=16), in_memory=True, memory_dir=memory_dir, knowledge_dir="")).open()
+
+    def test_least_recently_used_are_unloaded(self):
+        cache = VectorDBCache(max_size=2, max_idle_seconds=0)
+        a = self.get(cache, "a")
+        a.insert_text("kept in a")
+        self.get(cache, "b")
+        self.get(cache, "a")
+        self.get(cache, "c")  # b is the least recently used
+
+        self.assertTrue(a.ready.is_set())
+        self.assertFalse(cache.dbs["b"].ready.is_set())
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 3, "evictions": 1, "loaded": 2, "known": 3, "memory_mb": 0.0})
+
+        self.get(cache, "b")  # unloads a, its write is flushed
+        self.assertFalse(a.ready.is_set())
+        self.assertFalse(os.path.exists(a.oplog_path))
+        self.assertEqual(a.search_similarity("kept in a", 1)[0].page_content, "kept in a")  # reopened on use
+        self.get(cache, "b")
+        self.assertEqual((cache.stats()["hits"], cache.stats()["misses"]), (2, 4))
+
+    def test_idle_and_memory_limits(self):
+        cache = VectorDBCache(max_size=0, max_idle_seconds=0, max_memory_mb=0)
+        a = self.get(cache, "a")
+        a.insert_text("one")
+        self.assertGreater(a.memory_usage(), 0)
+
+        cache.configure(max_size=0, max_idle_seconds=0, max_memory_mb=a.memory_usage() / 2**20)
+        b = self.get(cache, "b")
+        b.insert_text("two")
+        self.get(cache, "b")  # over budget, a is unloaded
+        self.assertFalse(a.ready.is_set())
+
+        cache.configure(max_size=0, max_idle_seconds=0.01, max_memory_mb=0)
+        time.sleep(0.02)
+        cache.evict_idle()
+        self.assertFalse(b.ready.is_set())
+        self.assertEqual(cache.stats()["loaded"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()